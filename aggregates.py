@@ -0,0 +1,156 @@
+# Stands for "every portal" / "the whole city" in price_stats.
+ALL = '*'
+PERCENTILES = (10, 25, 50, 75, 90)
+
+# Width of the price per m² histogram buckets (zł/m²); percentiles are exact to within one bucket.
+BUCKET_WIDTH = 50
+
+def create_schema(cursor):
+    """Secondary indexes for the usual filters and the price per m² aggregate tables."""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_city_district ON listings (city, district)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_price ON listings (price)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_area ON listings (area)')
+    # Histogram of price per m² for every (portal, city, district); an unknown city or district is ''.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS price_buckets (
+            portal VARCHAR(15) NOT NULL,
+            city VARCHAR(15) NOT NULL,
+            district VARCHAR(50) NOT NULL,
+            bucket INTEGER NOT NULL,
+            listings INTEGER NOT NULL,
+            price_per_m2_sum REAL NOT NULL,
+            PRIMARY KEY (city, district, portal, bucket)
+        )
+    ''')
+    # Statistics per (portal, city, district), where portal and district can also be ALL.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS price_stats (
+            portal VARCHAR(15) NOT NULL,
+            city VARCHAR(15) NOT NULL,
+            district VARCHAR(50) NOT NULL,
+            listings INTEGER NOT NULL,
+            mean_price_per_m2 REAL NOT NULL,
+            p10_price_per_m2 REAL NOT NULL,
+            p25_price_per_m2 REAL NOT NULL,
+            median_price_per_m2 REAL NOT NULL,
+            p75_price_per_m2 REAL NOT NULL,
+            p90_price_per_m2 REAL NOT NULL,
+            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (portal, city, district)
+        )
+    ''')
+
+def groups_of(portal, city, district):
+    """The price_stats groups a listing counts in."""
+    city = city or ''
+    district = district or ''
+    return {(portal, city, district), (portal, city, ALL), (ALL, city, district), (ALL, city, ALL)}
+
+class PriceDeltas:
+    """Changes to the price_buckets histogram collected while writing a batch of listings."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.groups = set()
+
+    def add(self, portal, city, district, price, area, sign=1):
+        """Counts a listing in (sign=1) or out of (sign=-1) its histogram bucket."""
+        if not price or not area or price <= 0 or area <= 0:
+            return
+        price_per_m2 = price / area
+        key = (portal, city or '', district or '', int(price_per_m2 // BUCKET_WIDTH))
+        count, total = self.buckets.get(key, (0, 0.0))
+        self.buckets[key] = (count + sign, total + sign * price_per_m2)
+        self.groups |= groups_of(portal, city, district)
+
+    def apply(self, cursor):
+        """Writes the collected changes and refreshes the statistics of the groups they touch."""
+        changes = [(portal, city, district, bucket, count, total)
+                   for (portal, city, district, bucket), (count, total) in self.buckets.items() if count]
+        if changes:
+            cursor.executemany('''
+                INSERT INTO price_buckets (portal, city, district, bucket, listings, price_per_m2_sum)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (city, district, portal, bucket) DO UPDATE SET
+                    listings = listings + excluded.listings,
+                    price_per_m2_sum = price_per_m2_sum + excluded.price_per_m2_sum
+            ''', changes)
+            cursor.execute('DELETE FROM price_buckets WHERE listings <= 0')
+        refresh_aggregates(cursor, self.groups)
+        self.buckets.clear()
+        self.groups.clear()
+
+def _percentiles(buckets):
+    """Percentiles of a histogram given as sorted (bucket, listings) pairs.
+
+    Listings are assumed to be spread evenly inside their bucket.
+    """
+    total = sum(count for _, count in buckets)
+    values = []
+    for percent in PERCENTILES:
+        rank = (total - 1) * percent / 100
+        seen = 0
+        for bucket, count in buckets:
+            if rank < seen + count:
+                values.append((bucket + (rank - seen + 0.5) / count) * BUCKET_WIDTH)
+                break
+            seen += count
+    return values
+
+def refresh_aggregates(cursor, groups):
+    """Recomputes the price_stats rows of the given groups from their histograms.
+
+    The histograms are small and bounded by the price range rather than the
+    number of listings, so a refresh costs the same however large the table is.
+    """
+    for portal, city, district in groups:
+        conditions = ['city = ?']
+        params = [city]
+        if district != ALL:
+            conditions.append('district = ?')
+            params.append(district)
+        if portal != ALL:
+            conditions.append('portal = ?')
+            params.append(portal)
+        rows = cursor.execute(f'''
+            SELECT bucket, SUM(listings), SUM(price_per_m2_sum) FROM price_buckets
+            WHERE {" AND ".join(conditions)}
+            GROUP BY bucket HAVING SUM(listings) > 0 ORDER BY bucket
+        ''', params).fetchall()
+        if not rows:
+            cursor.execute('DELETE FROM price_stats WHERE portal = ? AND city = ? AND district = ?',
+                           (portal, city, district))
+            continue
+        listings = sum(row[1] for row in rows)
+        mean = sum(row[2] for row in rows) / listings
+        cursor.execute('''
+            INSERT INTO price_stats (portal, city, district, listings, mean_price_per_m2, p10_price_per_m2,
+                                     p25_price_per_m2, median_price_per_m2, p75_price_per_m2, p90_price_per_m2, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (portal, city, district) DO UPDATE SET
+                listings = excluded.listings,
+                mean_price_per_m2 = excluded.mean_price_per_m2,
+                p10_price_per_m2 = excluded.p10_price_per_m2,
+                p25_price_per_m2 = excluded.p25_price_per_m2,
+                median_price_per_m2 = excluded.median_price_per_m2,
+                p75_price_per_m2 = excluded.p75_price_per_m2,
+                p90_price_per_m2 = excluded.p90_price_per_m2,
+                updated_at = excluded.updated_at
+        ''', (portal, city, district, listings, mean, *_percentiles([(row[0], row[1]) for row in rows])))
+
+def rebuild_aggregates(cursor):
+    """Recomputes price_buckets and price_stats from the listings table."""
+    cursor.execute('DELETE FROM price_buckets')
+    cursor.execute('DELETE FROM price_stats')
+    cursor.execute(f'''
+        INSERT INTO price_buckets (portal, city, district, bucket, listings, price_per_m2_sum)
+        SELECT page, COALESCE(city, ''), COALESCE(district, ''),
+               CAST(price * 1.0 / area / {BUCKET_WIDTH} AS INTEGER), COUNT(*), SUM(price * 1.0 / area)
+        FROM listings
+        WHERE price > 0 AND area > 0
+        GROUP BY 1, 2, 3, 4
+    ''')
+    groups = set()
+    for portal, city, district in cursor.execute('SELECT DISTINCT portal, city, district FROM price_buckets').fetchall():
+        groups |= groups_of(portal, city, district)
+    refresh_aggregates(cursor, groups)
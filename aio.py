@@ -1,38 +1,50 @@
-import subprocess
+import asyncio
+import sys
+import http_client
+import metrics
+import portals
+from crawler import crawl
+from parsing import shutdown_pool
 from sqlworker import init_database
+from db_writer import DatabaseWriter
 
-scripts = [
-    "scraper_otodom.py",
-    "scraper_trojmiasto.py",
-    "scraper_olx.py"
-]
+def main(incremental=False, names=None, enrich=False, cities=None, offline=False):
+    """Crawls the named portals (all registered ones by default) in one event loop.
 
-def run_script(script_name):
+    `cities` limits the crawl to those cities of the portals. With `enrich`
+    the detail pages of the new and changed listings are fetched afterwards.
+    With `offline` pages are only read from the response cache, to re-run
+    the parsers on stored pages; pages missing from it fail, and the crawl
+    checkpoints are left alone.
+    """
+    selected = [portals.get(name) for name in names] if names else list(portals.load().values())
+    if offline:
+        http_client.cache.offline = True
     init_database()
-    print(f"Uruchamianie: {script_name}")
-    try:
-        result = subprocess.run(
-            ["python3", script_name],  
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        
-        stdout = result.stdout.decode('utf-8') if result.stdout else ''
-        stderr = result.stderr.decode('utf-8') if result.stderr else ''
-        
-        if result.returncode == 0:
-            print(f"Skrypt {script_name} zakończony sukcesem.")
-            print(f"Wynik:\n{stdout}")
+    with metrics.run():
+        try:
+            db = DatabaseWriter().start()
+            try:
+                for portal in selected:
+                    print(f"Uruchamianie: {portal.name}", flush=True)
+                results = asyncio.run(crawl(selected, db, incremental, cities=cities, offline=offline))
+            finally:
+                db.close()
+            if enrich:
+                # Runs after the writer has committed, so the whole crawl's queue is visible.
+                from enrich import enrich as enrich_details
+                asyncio.run(enrich_details([portal.name for portal in selected]))
+        finally:
+            http_client.close()
+            shutdown_pool()
+    for name, result in results.items():
+        if isinstance(result, BaseException):
+            print(f"Błąd podczas uruchamiania scrapera {name}: {result}", flush=True)
         else:
-            print(f"Błąd podczas uruchamiania skryptu {script_name}.\nKod wyjścia: {result.returncode}")
-            print("Szczegóły błędu:")
-            print(stderr)
-    except Exception as e:
-        print(f"Błąd: {e}")
-
-def main():
-    for script in scripts:
-        run_script(script)
+            print(f"Scraper {name} zakończony sukcesem.", flush=True)
 
 if __name__ == "__main__":
-    main()
+    # --incremental: daily refresh that stops once pages stop bringing changes
+    # --enrich: also fetch the detail pages of new and changed listings
+    # --offline: replay the pages in the response cache without touching the network
+    main(incremental="--incremental" in sys.argv, enrich="--enrich" in sys.argv, offline="--offline" in sys.argv)
@@ -0,0 +1,261 @@
+"""Offline benchmark of the scraping hot path.
+
+Replays the result pages saved in fixtures/ through a local HTTP server and
+measures, for every portal and scale (number of pages):
+
+- fetch: pages/s through FetchEngine and http_client against the local server,
+- parse: pages/s of the portal's parse_page (card extraction and max_page),
+  in-process and through the parser process pool (memory is the parent's only),
+- max_page: pages/s of the pagination rule alone,
+- upsert: pages/s and listings/s of DatabaseWorker.upsert_listings into a
+  fresh database,
+
+together with the peak Python memory of each stage. Results are printed (or
+written with --output) as JSON; --compare fails the run when a stage got
+slower than a saved result by more than --tolerance.
+
+    python benchmark.py --scales 10,100,1000 --output bench.json
+    python benchmark.py --compare bench.json
+    python benchmark.py --record   # refresh fixtures/ from the live portals
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http_client
+import portals
+import ratelimit
+from fetcher import FetchEngine
+from listing import Listing
+from parsing import make_soup, parse_in_pool, shutdown_pool
+from sqlworker import DatabaseWorker, DedupCache, init_database
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+# Page counts per run; add 10000 for a soak test (it takes a while).
+DEFAULT_SCALES = [10, 100, 1000]
+
+# Every fixture is the first results page of this city.
+FIXTURE_CITY = 'gdansk'
+
+@contextmanager
+def quiet():
+    """Hides the per-page progress the database code prints."""
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield
+
+def fixture_path(portal):
+    return os.path.join(FIXTURES_DIR, f"{portal}.html")
+
+def load_fixtures():
+    fixtures = {}
+    for name in portals.load():
+        with open(fixture_path(name), 'rb') as f:
+            fixtures[name] = f.read()
+    return fixtures
+
+def record_fixtures():
+    """Saves the first Gdańsk results page of every portal into fixtures/."""
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for name, portal in portals.load().items():
+        response = http_client.fetch(f"{portal.cities[FIXTURE_CITY]}{portal.first_page}", headers=portal.headers)
+        if response is None or response.status_code != 200:
+            print(f"Could not record {name}, keeping the old fixture")
+            continue
+        with open(fixture_path(name), 'wb') as f:
+            f.write(response.content)
+        print(f"Recorded {name}: {len(response.content)} bytes")
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    fixtures = {}
+
+    def do_GET(self):
+        portal = self.path.strip('/').split('/', 1)[0].split('?', 1)[0]
+        body = self.fixtures.get(portal)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(fixtures):
+    handler = type('FixtureHandler', (_FixtureHandler,), {'fixtures': fixtures})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def measure(prepare, pages, items=None):
+    """Times `prepare()()` and then runs it again under tracemalloc for its peak memory.
+
+    tracemalloc slows Python code down several times, so the two are kept
+    apart; `prepare` must return a fresh callable each time it is called.
+    """
+    run = prepare()
+    started = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - started
+
+    run = prepare()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        'pages': pages,
+        'seconds': round(seconds, 4),
+        'pages_per_sec': round(pages / seconds, 1) if seconds else None,
+        'peak_memory_bytes': peak,
+    }
+    if items is not None:
+        result['items_per_sec'] = round(items / seconds, 1) if seconds else None
+    return result
+
+def bench_fetch(base_url, portal, pages):
+    async def run():
+        engine = FetchEngine(concurrency=8, limits={base_url.split('//', 1)[1]: 8})
+        try:
+            urls = {page: f"{base_url}/{portal}?page={page}" for page in range(pages)}
+            async for _, response in engine.fetch_pages(urls):
+                if response is None or response.status_code != 200:
+                    raise RuntimeError(f"Local fetch of {portal} failed")
+        finally:
+            engine.close()
+    return measure(lambda: lambda: asyncio.run(run()), pages)
+
+def bench_parse(portal, content, pages):
+    return measure(lambda: lambda: [portal.parse(content) for _ in range(pages)], pages)
+
+def bench_parse_pool(portal, content, pages):
+    async def run():
+        await asyncio.gather(*(parse_in_pool(portal.parse_page, content) for _ in range(pages)))
+    asyncio.run(parse_in_pool(portal.parse_page, content))  # start the workers outside the timing
+    return measure(lambda: lambda: asyncio.run(run()), pages)
+
+def bench_max_page(portal, content, pages):
+    return measure(lambda: lambda: [portal.max_page(make_soup(content, portal.strainer))
+                                    for _ in range(pages)], pages)
+
+def bench_upsert(portal, rows, pages, directory):
+    batches = [Listing.from_rows((f"{row[0]} #{page}", *row[1:]) for row in rows) for page in range(pages)]
+    runs = 0
+
+    def prepare():
+        # Every run writes into a new database, otherwise the second one would find nothing to change.
+        nonlocal runs
+        runs += 1
+        db_name = os.path.join(directory, f"{portal}-{pages}-{runs}.db")
+        with quiet():
+            init_database(db_name)
+        worker = DatabaseWorker(DedupCache(), db_name=db_name)
+
+        def run():
+            with quiet():
+                for batch in batches:
+                    worker.upsert_listings(batch, portal)
+        return run
+    return measure(prepare, pages, items=len(rows) * pages)
+
+def run_benchmarks(scales, stages):
+    fixtures = load_fixtures()
+    server = start_server(fixtures)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    # Measure the code, not the politeness settings or the disk cache.
+    host = base_url.split('//', 1)[1]
+    ratelimit.host_rates[host] = 1e9
+    ratelimit.limiter_for(host).max_rate = 1e9
+    http_client.cache = None
+
+    results = {'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scales': scales, 'portals': {}}
+    directory = tempfile.mkdtemp(prefix='scraper-bench-')
+    try:
+        for name, portal in portals.load().items():
+            content = fixtures[name]
+            _, rows = portal.parse(content)
+            portal_results = results['portals'][name] = {
+                'fixture_bytes': len(content),
+                'listings_per_page': len(rows),
+            }
+            for scale in scales:
+                print(f"Benchmarking {name} at {scale} pages...", file=sys.stderr)
+                stage_results = portal_results[str(scale)] = {}
+                if 'fetch' in stages:
+                    stage_results['fetch'] = bench_fetch(base_url, name, scale)
+                if 'parse' in stages:
+                    stage_results['parse'] = bench_parse(portal, content, scale)
+                    stage_results['parse_pool'] = bench_parse_pool(portal, content, scale)
+                    stage_results['max_page'] = bench_max_page(portal, content, scale)
+                if 'upsert' in stages:
+                    stage_results['upsert'] = bench_upsert(name, rows, scale, directory)
+    finally:
+        server.shutdown()
+        shutdown_pool()
+        http_client.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Returns the stages whose pages/s dropped by more than `tolerance` against the baseline."""
+    regressions = []
+    for portal, scales in results['portals'].items():
+        for scale, stages in scales.items():
+            if not isinstance(stages, dict):
+                continue
+            for stage, current in stages.items():
+                previous = baseline.get('portals', {}).get(portal, {}).get(scale, {}).get(stage)
+                if not previous or not previous.get('pages_per_sec') or not current.get('pages_per_sec'):
+                    continue
+                change = current['pages_per_sec'] / previous['pages_per_sec'] - 1
+                if change < -tolerance:
+                    regressions.append(f"{portal} {stage} @ {scale} pages: "
+                                       f"{previous['pages_per_sec']} -> {current['pages_per_sec']} pages/s ({change:+.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of fetch, parse and upsert.")
+    parser.add_argument('--scales', default=",".join(map(str, DEFAULT_SCALES)),
+                        help="comma separated page counts (default: %(default)s)")
+    parser.add_argument('--stages', default="fetch,parse,upsert", help="comma separated stages to run")
+    parser.add_argument('--output', help="write the JSON results to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown (default: %(default)s)")
+    parser.add_argument('--record', action='store_true', help="re-record fixtures/ from the live portals")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures()
+        return
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    results = run_benchmarks(scales, set(args.stages.split(',')))
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report)
+    else:
+        print(report)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import sqlite3
+import time
+from sqlworker import DB_NAME
+
+# A run started longer ago than this is started over; pagination has shifted by then.
+RESUME_MAX_AGE = 24 * 3600
+
+# Statuses that count as finished for the current run.
+FINISHED = ('done', 'skipped')
+
+# Crawl modes; an incremental run requests the pages newest first, so its page numbers mean other listings.
+FULL = 'full'
+INCREMENTAL = 'incremental'
+
+# A page leased by a worker of a distributed crawl and not reported back within this time goes to another worker.
+LEASE_SECONDS = 120
+# A page that failed this many times is given up on for the run.
+MAX_PAGE_ATTEMPTS = 3
+
+class CrawlCheckpoint:
+    """Durable page-level state of one (portal, city) crawl, kept in crawl_pages.
+
+    begin() registers the pages of a run as pending. Pages are then marked
+    done (in the same transaction as their listings), failed or skipped. While
+    any page of the run is pending or failed, the next begin() resumes it and
+    returns only those pages, so a crash or ban never costs the pages already
+    stored and failed pages get retried without refetching the rest. A page
+    that failed `max_attempts` times is given up on for the run, like in a
+    distributed crawl. A run is only resumed by a crawl in the same `mode`;
+    the other mode starts over. `resumed` tells whether the last begin()
+    resumed a run.
+    """
+
+    def __init__(self, portal, city, db_name=DB_NAME, max_age=RESUME_MAX_AGE, mode=FULL,
+                 max_attempts=MAX_PAGE_ATTEMPTS):
+        self.portal = portal
+        self.city = city
+        self.db_name = db_name
+        self.max_age = max_age
+        self.mode = mode
+        self.max_attempts = max_attempts
+        self.resumed = False
+
+    def _connect(self):
+        return sqlite3.connect(self.db_name, timeout=30)
+
+    def _settled(self, status, attempts):
+        """Whether a page needs no more attempts in this run."""
+        return status in FINISHED or (status == 'failed' and attempts >= self.max_attempts)
+
+    def _resumable(self, rows, now):
+        """Whether the run in `rows` of (status, attempts, mode, run_started_at) has pages left and is recent."""
+        unsettled = [row for row in rows if not self._settled(row[0], row[1])]
+        started = min((row[3] for row in rows), default=now)
+        return bool(unsettled) and now - started < self.max_age and all(row[2] == self.mode for row in rows)
+
+    def _run_started(self, conn, now):
+        started = conn.execute('''
+            SELECT MIN(run_started_at) FROM crawl_pages WHERE portal = ? AND city = ?
+        ''', (self.portal, self.city)).fetchone()[0]
+        return now if started is None else started
+
+    def begin(self, first_page, max_page):
+        """Returns the pages still to crawl, resuming the previous run if it was left unfinished."""
+        pages = range(first_page, max_page + 1)
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute('''
+                SELECT page, status, attempts, mode, run_started_at FROM crawl_pages
+                WHERE portal = ? AND city = ?
+            ''', (self.portal, self.city)).fetchall()
+
+            self.resumed = self._resumable([row[1:] for row in rows], now)
+            if self.resumed:
+                settled = {page for page, status, attempts, _, _ in rows if self._settled(status, attempts)}
+                started = min(row[4] for row in rows)
+                conn.execute('''
+                    DELETE FROM crawl_pages WHERE portal = ? AND city = ? AND page > ?
+                ''', (self.portal, self.city, max_page))
+                conn.executemany('''
+                    INSERT OR IGNORE INTO crawl_pages (portal, city, page, status, mode, updated_at, run_started_at)
+                    VALUES (?, ?, ?, 'pending', ?, ?, ?)
+                ''', [(self.portal, self.city, page, self.mode, now, started) for page in pages])
+                remaining = [page for page in pages if page not in settled]
+                print(f"Resuming {self.portal} crawl for {self.city}: {len(remaining)} of {len(pages)} pages left")
+                return remaining
+
+            conn.execute('DELETE FROM crawl_pages WHERE portal = ? AND city = ?', (self.portal, self.city))
+            conn.executemany('''
+                INSERT INTO crawl_pages (portal, city, page, status, mode, updated_at, run_started_at)
+                VALUES (?, ?, ?, 'pending', ?, ?, ?)
+            ''', [(self.portal, self.city, page, self.mode, now, now) for page in pages])
+            return list(pages)
+
+    def seed(self, first_page):
+        """Starts a run whose length is not known yet with just first_page pending.
+
+        An unfinished run is resumed instead, with the leases of its pages
+        cleared; a run with only given-up pages left is started over, as
+        PageQueue would hand out none of them. Returns True when a run was
+        resumed.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute('''
+                SELECT status, attempts, mode, run_started_at FROM crawl_pages WHERE portal = ? AND city = ?
+            ''', (self.portal, self.city)).fetchall()
+            if self._resumable(rows, now):
+                unfinished = [row for row in rows if not self._settled(row[0], row[1])]
+                conn.execute('''
+                    UPDATE crawl_pages SET lease_owner = NULL, lease_until = NULL WHERE portal = ? AND city = ?
+                ''', (self.portal, self.city))
+                print(f"Resuming {self.portal} crawl for {self.city}: {len(unfinished)} of {len(rows)} pages left")
+                return True
+            conn.execute('DELETE FROM crawl_pages WHERE portal = ? AND city = ?', (self.portal, self.city))
+            conn.execute('''
+                INSERT INTO crawl_pages (portal, city, page, status, mode, updated_at, run_started_at)
+                VALUES (?, ?, ?, 'pending', ?, ?, ?)
+            ''', (self.portal, self.city, first_page, self.mode, now, now))
+            return False
+
+    def extend(self, first_page, max_page):
+        """Registers the pages of a seeded run once its first page told how many there are.
+
+        Pages already registered keep their state.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            started = self._run_started(conn, now)
+            conn.execute('''
+                DELETE FROM crawl_pages WHERE portal = ? AND city = ? AND page > ?
+            ''', (self.portal, self.city, max_page))
+            conn.executemany('''
+                INSERT OR IGNORE INTO crawl_pages (portal, city, page, status, mode, updated_at, run_started_at)
+                VALUES (?, ?, ?, 'pending', ?, ?, ?)
+            ''', [(self.portal, self.city, page, self.mode, now, started) for page in range(first_page, max_page + 1)])
+
+    def skip_pending(self):
+        """Marks the pages an incremental crawl decided not to visit as skipped."""
+        with self._connect() as conn:
+            conn.execute('''
+                UPDATE crawl_pages SET status = 'skipped', updated_at = ?
+                WHERE portal = ? AND city = ? AND status = 'pending'
+            ''', (time.time(), self.portal, self.city))
+
+    def summary(self):
+        """Returns {status: page count} for the current run."""
+        with self._connect() as conn:
+            return dict(conn.execute('''
+                SELECT status, COUNT(*) FROM crawl_pages
+                WHERE portal = ? AND city = ? GROUP BY status
+            ''', (self.portal, self.city)).fetchall())
+
+class PageQueue:
+    """The pages of several (portal, city) runs in crawl_pages, shared as a work queue.
+
+    Used by the coordinator of a distributed crawl (see distributed.py). A
+    page is leased to one worker at a time; a lease that is not settled within
+    `lease_seconds` expires and the page goes to the next worker asking.
+    Pages are settled like in a local crawl, by marking them done in the same
+    transaction as their listings, or failed; either clears the lease. Failed
+    pages are leased again until they reach `max_attempts`.
+
+    The coordinator only calls lease(), finished() and summary(), so a queue
+    kept elsewhere (e.g. in Redis) can take its place.
+    """
+
+    def __init__(self, targets, db_name=DB_NAME, lease_seconds=LEASE_SECONDS, max_attempts=MAX_PAGE_ATTEMPTS):
+        self.targets = list(targets)
+        self.db_name = db_name
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Keeps out the pages of other crawls sharing the table.
+        self._in_targets = f"(portal, city) IN (VALUES {', '.join(['(?, ?)'] * len(self.targets))})"
+        self._target_params = [value for target in self.targets for value in target]
+
+    def _connect(self):
+        return sqlite3.connect(self.db_name, timeout=30)
+
+    def lease(self, owner, limit):
+        """Leases up to `limit` pages to `owner`; returns their (portal, city, page), lowest pages first.
+
+        Going by page number hands out the first pages, which tell how many
+        pages follow, before the rest, and spreads a batch over the portals.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            return conn.execute(f'''
+                UPDATE crawl_pages SET lease_owner = ?, lease_until = ?
+                WHERE rowid IN (
+                    SELECT rowid FROM crawl_pages
+                    WHERE {self._in_targets}
+                      AND (status = 'pending' OR (status = 'failed' AND attempts < ?))
+                      AND (lease_until IS NULL OR lease_until < ?)
+                    ORDER BY page, portal, city
+                    LIMIT ?
+                )
+                RETURNING portal, city, page
+            ''', [owner, now + self.lease_seconds, *self._target_params, self.max_attempts, now, limit]).fetchall()
+
+    def finished(self):
+        """True once every page is done or skipped, or has failed `max_attempts` times."""
+        with self._connect() as conn:
+            left = conn.execute(f'''
+                SELECT COUNT(*) FROM crawl_pages
+                WHERE {self._in_targets}
+                  AND (status = 'pending' OR (status = 'failed' AND attempts < ?))
+            ''', [*self._target_params, self.max_attempts]).fetchone()[0]
+        return left == 0
+
+    def summary(self):
+        """Returns {(portal, city): {status: page count}}."""
+        summary = {}
+        with self._connect() as conn:
+            rows = conn.execute(f'''
+                SELECT portal, city, status, COUNT(*) FROM crawl_pages
+                WHERE {self._in_targets} GROUP BY portal, city, status
+            ''', self._target_params).fetchall()
+        for portal, city, status, count in rows:
+            summary.setdefault((portal, city), {})[status] = count
+        return summary
@@ -0,0 +1,153 @@
+import asyncio
+from checkpoint import FULL, INCREMENTAL, CrawlCheckpoint
+from fetcher import FetchEngine
+from listing import Listing
+import metrics
+from parsing import parse_in_pool
+
+# Incremental mode stops after this many consecutive pages without new or repriced listings.
+INCREMENTAL_STOP_AFTER = 2
+# Pages fetched at once in incremental mode, where the crawl has to move front to back.
+INCREMENTAL_WINDOW = 4
+
+def _failed(response):
+    return response is None or response.status_code != 200
+
+def newest_first(base_url, sort_query):
+    """Adds the portal's newest-first sort parameters in front of the page parameter."""
+    if not sort_query:
+        return base_url
+    return base_url.replace("?", f"?{sort_query}&", 1)
+
+async def crawl_city(portal, city, engine, db, incremental=False, stop_after=INCREMENTAL_STOP_AFTER, offline=False):
+    """Crawls the results pages of one city of a portal (see portals.Portal) and stores the listings found.
+
+    Pages are parsed in the parser process pool while the remaining ones are
+    still being downloaded.
+
+    With `incremental` the results are requested newest first (the portal's
+    `sort_newest`) and pages are crawled in small windows, front to back, until
+    `stop_after` consecutive pages bring no new listing and no price change.
+
+    Progress is checkpointed per page, so a crawl that died halfway resumes
+    with the pages it had not finished (see CrawlCheckpoint). An `offline`
+    replay of the response cache keeps out of the checkpoint, so its cache
+    misses do not turn the next online crawl into a resume of just those pages.
+    """
+    source, label, first_page, parse_page = portal.name, portal.label, portal.first_page, portal.parse_page
+    headers = portal.headers
+    print(f"Scraping {label} listings for {city}...")
+    base_url = portal.cities[city]
+    if incremental:
+        base_url = newest_first(base_url, portal.sort_newest)
+
+    response = await engine.fetch(f"{base_url}{first_page}", headers)
+    if _failed(response):
+        status = response.status_code if response is not None else None
+        print(f"Failed to fetch page {first_page} for {city}. HTTP Status Code: {status}")
+        return 0
+
+    max_page, first_rows = await parse_in_pool(parse_page, response.content, source)
+    print(f"Max pages for {city} on {label}: {max_page}")
+    parsed = {first_page: first_rows}
+    if offline:
+        checkpoint = None
+        pages = list(range(first_page, max_page + 1))
+    else:
+        checkpoint = CrawlCheckpoint(source, city, db.db_name, mode=INCREMENTAL if incremental else FULL)
+        pages = await asyncio.to_thread(checkpoint.begin, first_page, max_page)
+
+    async def mark(page, status):
+        if checkpoint is not None:
+            await asyncio.to_thread(db.mark_page, source, city, page, status)
+
+    async def process_page(page, response):
+        """Returns (listings stored, listings new or changed); changes are None when unknown."""
+        print(f"Scraping page {page} for {city}")
+
+        if _failed(response):
+            status = response.status_code if response is not None else None
+            print(f"Failed to fetch page {page} for {city}. HTTP Status Code: {status}")
+            await mark(page, 'failed')
+            return 0, None
+
+        # A resumed run retries pages whose listings may never have been stored,
+        # even if an earlier attempt left them fresh in the cache.
+        if response.unchanged and checkpoint is not None and not checkpoint.resumed:
+            parsed.pop(page, None)
+            print(f"Page {page} for {city} has not changed since the last run. Skipping.")
+            await mark(page, 'done')
+            return 0, 0
+
+        rows = parsed.pop(page, None)
+        if rows is None:
+            _, rows = await parse_in_pool(parse_page, response.content, source)
+        if not rows:
+            print(f"No listings found on page {page} for {city}.")
+            await mark(page, 'done')
+            return 0, 0
+        with metrics.timer('scraper_normalize_seconds', portal=source):
+            page_data, rejected = Listing.from_valid_rows(rows)
+        if rejected:
+            print(f"Left out {rejected} invalid listings from page {page} for {city}")
+        metrics.inc('scraper_listings_total', len(page_data), portal=source)
+        changed = await asyncio.to_thread(db.count_changes, page_data, source) if incremental else None
+        # May block while the database writer's queue is full.
+        page_mark = (city, page, 'done') if checkpoint is not None else None
+        await asyncio.to_thread(db.upsert_listings, page_data, source, page_mark)
+        return len(page_data), changed
+
+    prefetched = {first_page: response} if first_page in pages else None
+    all_listings = 0
+
+    if not incremental:
+        tasks = []
+        async for page, response in engine.fetch_pages({page: f"{base_url}{page}" for page in pages}, prefetched, headers):
+            tasks.append(asyncio.ensure_future(process_page(page, response)))
+        all_listings = sum(stored for stored, _ in await asyncio.gather(*tasks))
+    else:
+        quiet = 0
+        for start in range(0, len(pages), INCREMENTAL_WINDOW):
+            window = pages[start:start + INCREMENTAL_WINDOW]
+            tasks = {}
+            async for page, response in engine.fetch_pages({page: f"{base_url}{page}" for page in window}, prefetched, headers):
+                tasks[page] = asyncio.ensure_future(process_page(page, response))
+            prefetched = None
+            await asyncio.gather(*tasks.values())
+
+            for page in window:
+                stored, changed = tasks[page].result()
+                all_listings += stored
+                if changed is None:
+                    continue
+                quiet = quiet + 1 if changed == 0 else 0
+                if quiet >= stop_after:
+                    break
+            if quiet >= stop_after:
+                print(f"No new or changed listings on the last {quiet} pages for {city}. Stopping at page {page}.")
+                if checkpoint is not None:
+                    await asyncio.to_thread(checkpoint.skip_pending)
+                break
+
+    print(f"Finished scraping {label} for {city}. Total listings: {all_listings}")
+    return all_listings
+
+async def crawl(portals, db, incremental=False, concurrency=None, cities=None, offline=False):
+    """Crawls every city (or only the given `cities`) of the given portals at once, sharing one FetchEngine.
+
+    Returns {portal name: listings stored}, or the exception that stopped the
+    portal, so one failing portal does not take the others down.
+    """
+    engine = FetchEngine(concurrency=concurrency)
+
+    async def crawl_portal(portal):
+        selected = [city for city in portal.cities if cities is None or city in cities]
+        counts = await asyncio.gather(*(crawl_city(portal, city, engine, db, incremental, offline=offline)
+                                        for city in selected))
+        return sum(counts)
+
+    try:
+        results = await asyncio.gather(*(crawl_portal(portal) for portal in portals), return_exceptions=True)
+    finally:
+        engine.close()
+    return {portal.name: result for portal, result in zip(portals, results)}
@@ -0,0 +1,144 @@
+import queue
+import sqlite3
+import threading
+import time
+from typing import List
+from listing import Listing
+import metrics
+from sqlworker import DB_NAME, DatabaseWorker
+
+_STOP = object()
+
+class DatabaseWriter:
+    """Single writer thread owning the only connection that writes to listings.db.
+
+    Scrapers hand pages of listings to upsert_listings(), which only enqueues
+    them. The writer groups everything queued into one transaction, committed
+    once `batch_size` listings have accumulated or `flush_interval` seconds have
+    passed. The queue is bounded, so producers block when the writer falls
+    behind instead of piling pages up in memory.
+    """
+
+    def __init__(self, db_name=DB_NAME, max_queue=256, batch_size=5000, flush_interval=2.0):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.worker = DatabaseWorker(db_name=db_name)
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def upsert_listings(self, listings: List[Listing], source: str, page_mark=None):
+        """Queues listings; page_mark=(city, page, status) is committed together with them."""
+        if self._error is not None:
+            raise RuntimeError(f"Database writer stopped: {self._error}")
+        self._queue.put((source, listings, page_mark))
+
+    def mark_page(self, source: str, city: str, page: int, status: str):
+        self.upsert_listings([], source, (city, page, status))
+
+    def count_changes(self, listings: List[Listing], source: str):
+        return self.worker.count_changes(listings, source)
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            self._error = e
+            print(f"Could not open {self.db_name} for writing: {e}")
+            self._drain()
+            return
+
+        batch = []
+        pending = 0
+        deadline = None
+        stopped = False
+        try:
+            while True:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is _STOP:
+                    stopped = True
+                    break
+                if item is not None:
+                    batch.append(item)
+                    pending += max(1, len(item[1]))
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+
+                if pending >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                    self._flush(conn, batch)
+                    batch, pending, deadline = [], 0, None
+            if batch:
+                self._flush(conn, batch)
+        except Exception as e:
+            # Anything but a database error (handled per batch in _flush) stops the writer;
+            # callers get the error instead of blocking on a queue nobody empties.
+            self._error = e
+            lost = sum(len(listings) for _, listings, _ in batch)
+            self.failed += lost
+            metrics.inc('scraper_db_failed_listings_total', lost)
+            print(f"Database writer stopped, {lost} listings were not saved: {e!r}")
+            if not stopped:
+                self._drain()
+        finally:
+            conn.close()
+
+    def _flush(self, conn, batch):
+        counts = {}
+        touched_keys = []
+        marks = []
+        started = time.monotonic()
+        try:
+            with conn:
+                for source, listings, page_mark in batch:
+                    if page_mark:
+                        marks.append((source, *page_mark))
+                    if not listings:
+                        continue
+                    updated, inserted, keys = self.worker.write_listings(conn, listings, source)
+                    touched_keys.extend(keys)
+                    total_updated, total_inserted = counts.get(source, (0, 0))
+                    counts[source] = (total_updated + updated, total_inserted + inserted)
+                if marks:
+                    self.worker.mark_pages(conn, marks)
+        except Exception as e:
+            self.worker.forget(touched_keys)
+            if not isinstance(e, sqlite3.Error):
+                raise
+            lost = sum(len(listings) for _, listings, _ in batch)
+            self.failed += lost
+            metrics.inc('scraper_db_failed_listings_total', lost)
+            print(f"An error occurred while puting the data into database, {lost} listings were not saved: {e}")
+            return
+        elapsed = time.monotonic() - started
+        metrics.observe('scraper_db_transaction_seconds', elapsed)
+        for source, (updated, inserted) in counts.items():
+            metrics.inc('scraper_db_listings_total', updated, portal=source, result='updated')
+            metrics.inc('scraper_db_listings_total', inserted, portal=source, result='inserted')
+            print(f"Updated {updated} and inserted {inserted} listings from {source}")
+        print(f"Committed {len(batch)} pages in {elapsed:.2f}s")
+
+    def _drain(self):
+        # Keep producers from blocking forever on a writer that cannot write.
+        while self._queue.get() is not _STOP:
+            pass
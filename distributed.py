@@ -0,0 +1,259 @@
+import asyncio
+import hmac
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+import http_client
+import metrics
+import portals
+import ratelimit
+from checkpoint import CrawlCheckpoint, PageQueue
+from db_writer import DatabaseWriter
+from fetcher import FetchEngine
+from listing import Listing
+from parsing import parse_in_pool, shutdown_pool
+from sqlworker import DB_NAME, init_database
+
+# Port the coordinator listens on by default.
+COORDINATOR_PORT = 8765
+# Address the coordinator listens on by default; other machines need --host and a token.
+COORDINATOR_HOST = '127.0.0.1'
+# Shared secret workers send to the coordinator, read from the environment to keep it out of argv.
+TOKEN_ENV = 'SCRAPER_COORDINATOR_TOKEN'
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+# Pages a worker leases at once and reports back in one request.
+BATCH_PAGES = 20
+# Seconds between two checks of the queue, by the coordinator and by an idle worker.
+POLL_SECONDS = 2.0
+# Tries of a request to the coordinator, POLL_SECONDS apart and doubling, before a worker gives up on it.
+POST_ATTEMPTS = 5
+
+class Coordinator:
+    """Hands out the pages of a distributed crawl and stores what the workers send back.
+
+    The coordinator is the only process using the database: it keeps the page
+    queue (a PageQueue over crawl_pages) and the single DatabaseWriter, while
+    the workers, possibly on other machines, do the fetching and parsing.
+    Every (portal, city) starts with its first page only; the page count that
+    page reports adds the rest of the pages to the queue.
+    """
+
+    def __init__(self, plan, db, db_name=DB_NAME):
+        self.portals = {portal.name: portal for portal, _ in plan}
+        self.targets = [(portal.name, city) for portal, cities in plan for city in cities]
+        self.queue = PageQueue(self.targets, db_name)
+        self.db = db
+        self.db_name = db_name
+        self.pages = 0
+        self._lock = threading.Lock()
+
+    def seed(self):
+        # The queue must not take a run for finished that the checkpoint resumes.
+        for name, city in self.targets:
+            checkpoint = CrawlCheckpoint(name, city, self.db_name, max_attempts=self.queue.max_attempts)
+            checkpoint.seed(self.portals[name].first_page)
+
+    def lease(self, worker, limit):
+        """Returns up to `limit` tasks as [portal, city, page, url] and whether the whole crawl is over."""
+        tasks = [[name, city, page, f"{self.portals[name].cities[city]}{page}"]
+                 for name, city, page in self.queue.lease(worker, limit)]
+        return {'tasks': tasks, 'finished': not tasks and self.queue.finished()}
+
+    def results(self, worker, results):
+        """Stores a batch of page results; `rows` is None for a page the worker could not crawl.
+
+        A page that cannot be stored is marked failed, so it is retried like a
+        failed download instead of taking the rest of the batch down with it.
+        """
+        for result in results:
+            name, city, page = result['portal'], result['city'], result['page']
+            try:
+                self._store(name, city, page, result.get('max_page'), result['rows'])
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Could not store page {page} for {city} on {name} from {worker}: {e!r}")
+                self.db.mark_page(name, city, page, 'failed')
+        with self._lock:
+            self.pages += len(results)
+        return {'stored': len(results)}
+
+    def _store(self, name, city, page, max_page, rows):
+        if rows is None:
+            self.db.mark_page(name, city, page, 'failed')
+            return
+        portal = self.portals[name]
+        if page == portal.first_page and max_page:
+            CrawlCheckpoint(name, city, self.db_name).extend(page, int(max_page))
+            print(f"Max pages for {city} on {portal.label}: {max_page}")
+        listings, rejected = Listing.from_valid_rows(rows)
+        if rejected:
+            print(f"Left out {rejected} invalid listings from page {page} for {city} on {portal.label}")
+        metrics.inc('scraper_listings_total', len(listings), portal=name)
+        # May block while the database writer's queue is full, which slows the workers down with it.
+        self.db.upsert_listings(listings, name, (city, page, 'done'))
+
+def serve(coordinator, port=COORDINATOR_PORT, host=COORDINATOR_HOST, token=None):
+    """Serves the coordinator from daemon threads; returns the server.
+
+    With a `token`, requests without "Authorization: Bearer <token>" are
+    refused. Workers POST JSON to two paths:
+
+    - /lease {"worker": id, "limit": n} -> {"tasks": [[portal, city, page, url], ...], "finished": bool}
+    - /results {"worker": id, "results": [{"portal", "city", "page", "max_page", "rows"}, ...]}
+    """
+    routes = {
+        '/lease': lambda body: coordinator.lease(body['worker'], int(body.get('limit', BATCH_PAGES))),
+        '/results': lambda body: coordinator.results(body['worker'], body['results']),
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            route = routes.get(self.path)
+            if route is None:
+                self.send_error(404)
+                return
+            if token and not hmac.compare_digest(self.headers.get('Authorization', ''), f"Bearer {token}"):
+                self.send_error(403)
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                reply = route(body)
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                # Always answer, so the worker can tell a failed request from a lost coordinator.
+                print(f"Coordinator failed on {self.path}: {e!r}")
+                self.send_error(500, str(e))
+                return
+            data = json.dumps(reply).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="coordinator", daemon=True).start()
+    print(f"Coordinating on {host}:{server.server_address[1]}")
+    return server
+
+def coordinate(plan, port=COORDINATOR_PORT, db_name=DB_NAME, host=COORDINATOR_HOST):
+    """Runs the coordinator for `plan`, [(portal, [city, ...])], until every page is settled.
+
+    An unfinished distributed crawl of the same cities is resumed, like a
+    local one. Anything that reaches the port can store listings, so
+    listening beyond localhost requires the SCRAPER_COORDINATOR_TOKEN shared
+    with the workers. Returns the number of pages the workers reported.
+    """
+    token = os.environ.get(TOKEN_ENV)
+    if host not in LOCAL_HOSTS and not token:
+        raise SystemExit(f"Set {TOKEN_ENV} here and on the workers to coordinate on {host}")
+    init_database(db_name)
+    with metrics.run():
+        db = DatabaseWriter(db_name).start()
+        coordinator = Coordinator(plan, db, db_name)
+        coordinator.seed()
+        server = serve(coordinator, port, host, token)
+        try:
+            while not coordinator.queue.finished():
+                time.sleep(POLL_SECONDS)
+            # Gives the idle workers one more poll to learn that the crawl is over.
+            time.sleep(2 * POLL_SECONDS)
+        finally:
+            server.shutdown()
+            server.server_close()
+            db.close()
+    for (name, city), statuses in sorted(coordinator.queue.summary().items()):
+        pages = ", ".join(f"{count} {status}" for status, count in sorted(statuses.items()))
+        print(f"Finished {name} for {city}: {pages} pages")
+    return coordinator.pages
+
+async def work(coordinator_url, worker=None, batch=BATCH_PAGES, concurrency=None):
+    """Crawls pages leased from the coordinator until it reports the crawl over; returns the pages crawled.
+
+    Requests go through this machine's own rate limiters and cache, so every
+    worker node keeps to the per-host limits from its own address.
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    coordinator_url = coordinator_url.rstrip('/')
+    registry = portals.load()
+    session = requests.Session()
+    token = os.environ.get(TOKEN_ENV)
+    if token:
+        session.headers['Authorization'] = f"Bearer {token}"
+
+    def post(path, body):
+        for attempt in range(POST_ATTEMPTS):
+            try:
+                response = session.post(f"{coordinator_url}{path}", json=body, timeout=120)
+                response.raise_for_status()
+                return response.json()
+            except requests.RequestException as e:
+                rejected = isinstance(e, requests.HTTPError) and e.response.status_code < 500
+                if rejected or attempt == POST_ATTEMPTS - 1:
+                    raise
+                delay = POLL_SECONDS * 2 ** attempt
+                print(f"Request to {coordinator_url}{path} failed ({e}), retrying in {delay:.0f} seconds")
+                time.sleep(delay)
+
+    async def crawl_page(name, city, page, url):
+        portal = registry[name]
+        result = {'portal': name, 'city': city, 'page': page, 'max_page': None, 'rows': None}
+        response = await engine.fetch(url, portal.headers)
+        if response is None or response.status_code != 200:
+            status = response.status_code if response is not None else None
+            print(f"Failed to fetch page {page} for {city} on {portal.label}. HTTP Status Code: {status}")
+            return result
+        # Parsed even when unchanged: the page may be leased again because its first report was lost.
+        try:
+            result['max_page'], result['rows'] = await parse_in_pool(portal.parse_page, response.content, name)
+        except Exception as e:
+            print(f"Failed to parse page {page} for {city} on {portal.label}: {e}")
+        return result
+
+    engine = FetchEngine(concurrency=concurrency)
+    pages = 0
+    try:
+        while True:
+            reply = await asyncio.to_thread(post, '/lease', {'worker': worker, 'limit': batch})
+            if not reply['tasks']:
+                if reply['finished']:
+                    break
+                await asyncio.sleep(POLL_SECONDS)
+                continue
+            results = await asyncio.gather(*(crawl_page(*task) for task in reply['tasks']))
+            try:
+                await asyncio.to_thread(post, '/results', {'worker': worker, 'results': results})
+            except requests.RequestException as e:
+                # The coordinator hands these pages out again once their leases expire.
+                print(f"Could not report {len(results)} pages to the coordinator: {e}")
+                continue
+            pages += len(results)
+    except requests.RequestException as e:
+        print(f"Lost the coordinator at {coordinator_url}: {e}")
+    finally:
+        engine.close()
+        session.close()
+    print(f"Worker {worker} crawled {pages} pages")
+    return pages
+
+def run_worker(coordinator_url, batch=BATCH_PAGES, concurrency=None, rate=None):
+    """Runs a worker process; `rate` overrides the starting requests per second of every host on this node."""
+    if rate:
+        ratelimit.DEFAULT_RATE = rate
+        for host in ratelimit.host_rates:
+            ratelimit.host_rates[host] = rate
+    try:
+        with metrics.run():
+            return asyncio.run(work(coordinator_url, batch=batch, concurrency=concurrency))
+    finally:
+        http_client.close()
+        shutdown_pool()
@@ -0,0 +1,156 @@
+import math
+import re
+import unicodedata
+
+# Listings match when their areas differ by at most this many m²...
+AREA_TOLERANCE = 1.0
+# ...their prices by at most this fraction...
+PRICE_TOLERANCE = 0.05
+# ...and their titles share this share of words (identical price and area need no title match).
+TITLE_THRESHOLD = 0.2
+
+# Width of the price bands used for blocking, as a ratio between neighbouring bands.
+PRICE_BAND_RATIO = 1.05
+
+# Block keys or listing ids per query, within the 999 variables older SQLite builds allow.
+QUERY_CHUNK = 500
+
+_WORD = re.compile(r"[a-z0-9]+")
+_LETTERS = str.maketrans({"ł": "l", "Ł": "l"})
+
+def normalize(text):
+    """Lowercases text and strips Polish diacritics ("Gdańsk" -> "gdansk")."""
+    if not text:
+        return ""
+    if text.isascii():
+        return text.lower().strip()
+    text = unicodedata.normalize("NFKD", text.translate(_LETTERS))
+    return "".join(char for char in text if not unicodedata.combining(char)).lower().strip()
+
+def title_tokens(title):
+    return {word for word in _WORD.findall(normalize(title)) if len(word) > 2}
+
+def _block(city, district, area_bucket, price_band):
+    return f"{city}|{district}|{area_bucket}|{price_band}"
+
+def fingerprint(city, district, area, price):
+    """Returns the block key of a listing, or None when it lacks the data to be matched.
+
+    Portals spell districts differently ("Wrzeszcz" vs "Wrzeszcz Górny"), so
+    only the first word of the district takes part.
+    """
+    if not city or not area or not price or area <= 0 or price <= 0:
+        return None
+    district_words = normalize(district).split()
+    return (normalize(city), district_words[0] if district_words else "",
+            int(area), int(math.log(price, PRICE_BAND_RATIO)))
+
+def neighbour_blocks(key):
+    """The block of a listing and the eight around it, so bucket edges do not split matches."""
+    city, district, area_bucket, price_band = key
+    return [_block(city, district, area_bucket + da, price_band + dp)
+            for da in (-1, 0, 1) for dp in (-1, 0, 1)]
+
+def is_match(price, area, tokens, other_price, other_area, other_tokens):
+    if abs(area - other_area) > AREA_TOLERANCE:
+        return False
+    if abs(price - other_price) > PRICE_TOLERANCE * max(price, other_price):
+        return False
+    if price == other_price and abs(area - other_area) < 0.01:
+        return True
+    if not tokens or not other_tokens:
+        return False
+    return len(tokens & other_tokens) / len(tokens | other_tokens) >= TITLE_THRESHOLD
+
+def _chunks(values, size=QUERY_CHUNK):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def index_listings(cursor, source, rows):
+    """Fingerprints stored listings and assigns their cross-portal cluster ids.
+
+    `rows` are (listing_id, title, price, city, district, area) of listings
+    that were just inserted or changed. Each one is compared only with the
+    listings of other portals in its neighbouring blocks, so the cost grows
+    with the number of listings written, not with the size of the table. A
+    listing joins the lowest cluster id among its current matches (merging
+    clusters it bridges); without a match, or without the data to be matched,
+    its cluster id is its own listing_id. A changed listing leaves its old
+    cluster; if the cluster carried its id, the remaining members take the
+    lowest of theirs.
+
+    The whole batch costs a handful of statements: candidates are read per
+    chunk of block keys and everything is written with executemany.
+    """
+    if not rows:
+        return
+    ids = [row[0] for row in rows]
+    previous = {}
+    for chunk in _chunks(ids):
+        placeholders = ", ".join(["?"] * len(chunk))
+        previous.update(cursor.execute(f'''
+            SELECT listing_id, cluster_id FROM listings WHERE listing_id IN ({placeholders})
+        ''', chunk))
+    cursor.executemany('''
+        UPDATE listings SET cluster_id = (SELECT MIN(listing_id) FROM listings WHERE cluster_id = ? AND listing_id != ?)
+        WHERE cluster_id = ? AND listing_id != ?
+    ''', [(listing_id,) * 4 for listing_id in ids if previous.get(listing_id) == listing_id])
+
+    keyed = []
+    unkeyed = []
+    for listing_id, title, price, city, district, area in rows:
+        key = fingerprint(city, district, area, price)
+        if key is None:
+            unkeyed.append(listing_id)
+        else:
+            keyed.append((listing_id, title_tokens(title), price, area, key, neighbour_blocks(key)))
+    cursor.executemany('DELETE FROM listing_fingerprints WHERE listing_id = ?', [(listing_id,) for listing_id in unkeyed])
+
+    # Other portals' listings in any of the batch's blocks, read after the relabelling above.
+    candidates = {}
+    blocks = list({block for *_, neighbours in keyed for block in neighbours})
+    for chunk in _chunks(blocks):
+        placeholders = ", ".join(["?"] * len(chunk))
+        for block_key, price, area, tokens, cluster_id in cursor.execute(f'''
+            SELECT f.block_key, f.price, f.area, f.tokens, l.cluster_id
+            FROM listing_fingerprints f JOIN listings l ON l.listing_id = f.listing_id
+            WHERE f.block_key IN ({placeholders}) AND f.portal != ?
+        ''', [*chunk, source]):
+            if cluster_id is not None:
+                candidates.setdefault(block_key, []).append((price, area, set(tokens.split()), cluster_id))
+
+    # Clusters merged by this batch, old id -> lower id; the candidates still carry the old ids.
+    renamed = {}
+
+    def resolve(cluster_id):
+        while cluster_id in renamed:
+            cluster_id = renamed[cluster_id]
+        return cluster_id
+
+    assigned = {listing_id: listing_id for listing_id in unkeyed}
+    fingerprints = []
+    for listing_id, tokens, price, area, key, neighbours in keyed:
+        clusters = {resolve(cluster_id)
+                    for block in neighbours
+                    for other_price, other_area, other_tokens, cluster_id in candidates.get(block, ())
+                    if is_match(price, area, tokens, other_price, other_area, other_tokens)}
+        cluster_id = min(clusters) if clusters else listing_id
+        for other in clusters:
+            if other != cluster_id:
+                renamed[other] = cluster_id
+        assigned[listing_id] = cluster_id
+        fingerprints.append((listing_id, source, _block(*key), price, area, " ".join(sorted(tokens))))
+
+    cursor.executemany('''
+        INSERT INTO listing_fingerprints (listing_id, portal, block_key, price, area, tokens)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (listing_id) DO UPDATE SET
+            block_key = excluded.block_key,
+            price = excluded.price,
+            area = excluded.area,
+            tokens = excluded.tokens
+    ''', fingerprints)
+    cursor.executemany('UPDATE listings SET cluster_id = ? WHERE listing_id = ?',
+                       [(resolve(cluster_id), listing_id) for listing_id, cluster_id in assigned.items()])
+    cursor.executemany('UPDATE listings SET cluster_id = ? WHERE cluster_id = ?',
+                       [(resolve(old), old) for old in renamed])
@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import re
+import sqlite3
+import http_client
+import metrics
+import portals
+from fetcher import FetchEngine
+from parsing import parse_in_pool, shutdown_pool
+from sqlworker import DB_NAME, DETAIL_PRIORITY_BACKFILL, init_database
+
+# Detail pages downloaded at once; the per-host limits of FetchEngine still apply.
+ENRICH_WORKERS = 8
+# Listings written per transaction.
+BATCH_SIZE = 100
+# A listing whose detail page failed this many times is left alone until it changes again.
+MAX_ATTEMPTS = 3
+# Statuses meaning the offer is gone for good.
+GONE_STATUSES = {404, 410}
+
+_NUMBER = re.compile(r"-?\d+")
+_ROOM_WORDS = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8,
+               'nine': 9, 'ten': 10}
+_GROUND_FLOOR = ('ground', 'parter', 'floor_0')
+_BASEMENT = ('cellar', 'suterena')
+
+def _int(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = _NUMBER.search(str(value))
+    return int(match.group()) if match else None
+
+def _float(value):
+    try:
+        return float(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+def _rooms(value):
+    if isinstance(value, str) and value.lower() in _ROOM_WORDS:
+        return _ROOM_WORDS[value.lower()]
+    return _int(value)
+
+def _floor(value):
+    if isinstance(value, str):
+        text = value.lower()
+        if any(word in text for word in _GROUND_FLOOR):
+            return 0
+        if any(word in text for word in _BASEMENT):
+            return -1
+    return _int(value)
+
+def normalize_details(details):
+    """Turns the portal's raw detail values into (rooms, floor, build_year, latitude, longitude)."""
+    return (
+        _rooms(details.get('rooms')),
+        _floor(details.get('floor')),
+        _int(details.get('build_year')),
+        _float(details.get('latitude')),
+        _float(details.get('longitude')),
+    )
+
+def detail_url(url):
+    """Listings store their url without the scheme ("www.olx.pl/d/oferta/...")."""
+    return url if "://" in url else f"https://{url}"
+
+def load_queue(db_name, names, limit=None):
+    """Returns (priority, listing_id, portal, url, queued_at) of the queued listings, most urgent first."""
+    placeholders = ", ".join(["?"] * len(names))
+    with sqlite3.connect(db_name, timeout=30) as conn:
+        return conn.execute(f'''
+            SELECT q.priority, q.listing_id, l.page, l.url, q.queued_at
+            FROM detail_queue q JOIN listings l ON l.listing_id = q.listing_id
+            WHERE l.page IN ({placeholders}) AND q.attempts < ?
+            ORDER BY q.priority, q.queued_at
+            LIMIT ?
+        ''', [*names, MAX_ATTEMPTS, -1 if limit is None else limit]).fetchall()
+
+def write_details(db_name, done, failed, gone):
+    """Stores a batch of detail values and settles the queue entries they came from.
+
+    An entry re-queued after it was loaded (the listing changed meanwhile) is
+    kept, so the newer version gets its details fetched too.
+    """
+    with sqlite3.connect(db_name, timeout=30) as conn:
+        conn.executemany('''
+            UPDATE listings
+            SET rooms = ?, floor = ?, build_year = ?, latitude = ?, longitude = ?, details_at = CURRENT_TIMESTAMP
+            WHERE listing_id = ?
+        ''', [(*values, listing_id) for listing_id, _, values in done])
+        conn.executemany('DELETE FROM detail_queue WHERE listing_id = ? AND queued_at = ?',
+                         [(listing_id, queued_at) for listing_id, queued_at, _ in done] + gone)
+        conn.executemany('UPDATE detail_queue SET attempts = attempts + 1 WHERE listing_id = ?',
+                         [(listing_id,) for listing_id in failed])
+
+def backfill(db_name=DB_NAME, limit=1000):
+    """Queues up to `limit` listings that never had their details fetched, behind new and changed ones."""
+    with sqlite3.connect(db_name, timeout=30) as conn:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO detail_queue (listing_id, priority)
+            SELECT listing_id, ? FROM listings
+            WHERE details_at IS NULL AND url IS NOT NULL
+            ORDER BY listing_id DESC
+            LIMIT ?
+        ''', (DETAIL_PRIORITY_BACKFILL, limit))
+        return cursor.rowcount
+
+async def enrich(names=None, db_name=DB_NAME, workers=ENRICH_WORKERS, limit=None, engine=None):
+    """Fetches the detail pages of queued (new or changed) listings and stores what they add.
+
+    Listings are taken from detail_queue in priority order (new before
+    changed before backfill) by `workers` concurrent workers, and written
+    back in batches of BATCH_SIZE. Returns the number of listings enriched.
+    """
+    selected = [portals.get(name) for name in names] if names else list(portals.load().values())
+    by_name = {portal.name: portal for portal in selected if portal.details is not None}
+    if not by_name:
+        return 0
+    items = await asyncio.to_thread(load_queue, db_name, list(by_name), limit)
+    if not items:
+        print("No listings waiting for details.")
+        return 0
+    print(f"Fetching details of {len(items)} listings...")
+
+    queue = asyncio.PriorityQueue()
+    for sequence, (priority, listing_id, name, url, queued_at) in enumerate(items):
+        queue.put_nowait((priority, sequence, listing_id, name, url, queued_at))
+
+    done, failed, gone = [], [], []
+    enriched = 0
+
+    async def flush():
+        nonlocal done, failed, gone, enriched
+        batch = (done, failed, gone)
+        done, failed, gone = [], [], []
+        if any(batch):
+            await asyncio.to_thread(write_details, db_name, *batch)
+            enriched += len(batch[0])
+
+    async def worker():
+        while True:
+            try:
+                _, _, listing_id, name, url, queued_at = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            portal = by_name[name]
+            response = await engine.fetch(detail_url(url), portal.headers) if url else None
+            if response is not None and response.status_code in GONE_STATUSES:
+                gone.append((listing_id, queued_at))
+                result = 'gone'
+            elif response is None or response.status_code != 200:
+                failed.append(listing_id)
+                result = 'failed'
+            else:
+                details = await parse_in_pool(portal.parse_details, response.content, name)
+                if details is None:
+                    failed.append(listing_id)
+                    result = 'unparsed'
+                else:
+                    done.append((listing_id, queued_at, normalize_details(details)))
+                    result = 'done'
+            metrics.inc('scraper_details_total', portal=name, result=result)
+            if len(done) + len(failed) + len(gone) >= BATCH_SIZE:
+                await flush()
+
+    own_engine = engine is None
+    engine = engine or FetchEngine()
+    try:
+        await asyncio.gather(*(worker() for _ in range(workers)))
+    finally:
+        await flush()
+        if own_engine:
+            engine.close()
+    print(f"Enriched {enriched} listings with details.")
+    return enriched
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch detail pages of new and changed listings.")
+    parser.add_argument('--portals', nargs='+', help="portals to enrich (default: all)")
+    parser.add_argument('--limit', type=int, help="at most this many listings")
+    parser.add_argument('--workers', type=int, default=ENRICH_WORKERS)
+    parser.add_argument('--backfill', type=int, metavar='N',
+                        help="first queue up to N listings that never had their details fetched")
+    args = parser.parse_args()
+    run(args.portals, args.workers, args.limit, args.backfill)
+
+def run(names=None, workers=ENRICH_WORKERS, limit=None, backfill_limit=None):
+    """Enriches the queued listings of the named portals as a standalone run."""
+    init_database()
+    if backfill_limit:
+        print(f"Queued {backfill(DB_NAME, backfill_limit)} listings for backfill.")
+    try:
+        with metrics.run():
+            asyncio.run(enrich(names, workers=workers, limit=limit))
+    finally:
+        http_client.close()
+        shutdown_pool()
+
+if __name__ == "__main__":
+    main()
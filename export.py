@@ -0,0 +1,136 @@
+import argparse
+import os
+import sqlite3
+import time
+from sqlworker import DB_NAME
+
+EXPORT_DIR = "export"
+# Rows fetched from SQLite and written per file; bounds the memory used by an export.
+CHUNK_ROWS = 50_000
+
+FORMATS = {
+    'parquet': 'parquet',
+    'arrow': 'ipc',
+}
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        return pyarrow
+    except ImportError:
+        raise SystemExit("Exporting requires pyarrow: pip install pyarrow")
+
+def _schemas(pa):
+    listings = pa.schema([
+        ('listing_id', pa.int64()),
+        ('portal', pa.string()),
+        ('title', pa.string()),
+        ('price', pa.int64()),
+        ('city', pa.string()),
+        ('district', pa.string()),
+        ('area', pa.float64()),
+        ('url', pa.string()),
+        ('cluster_id', pa.int64()),
+        ('updated_at', pa.string()),
+        ('date', pa.string()),
+    ])
+    prices = pa.schema([
+        ('listing_id', pa.int64()),
+        ('portal', pa.string()),
+        ('city', pa.string()),
+        ('price', pa.int64()),
+        ('area', pa.float64()),
+        ('observed_at', pa.string()),
+        ('date', pa.string()),
+    ])
+    return listings, prices
+
+# Both queries select the rows written by the changes numbered (since, until]; date is the partition column.
+LISTINGS_QUERY = '''
+    SELECT listing_id, page, title, price, city, district, area, url, cluster_id, updated_at, date(updated_at)
+    FROM listings
+    WHERE change_seq > ? AND change_seq <= ?
+'''
+
+PRICES_QUERY = '''
+    SELECT p.listing_id, l.page, l.city, p.price, p.area, p.observed_at, date(p.observed_at)
+    FROM listing_prices p JOIN listings l ON l.listing_id = p.listing_id
+    WHERE p.change_seq > ? AND p.change_seq <= ?
+'''
+
+def _export_table(pa, conn, query, params, schema, directory, file_format, run_id):
+    """Streams a query into a portal/city/date partitioned dataset, one chunk at a time."""
+    cursor = conn.execute(query, params)
+    extension = 'parquet' if file_format == 'parquet' else 'arrow'
+    total = 0
+    chunk_number = 0
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            break
+        columns = list(zip(*rows))
+        table = pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema,
+        )
+        pa.dataset.write_dataset(
+            table,
+            directory,
+            format=file_format,
+            partitioning=['portal', 'city', 'date'],
+            partitioning_flavor='hive',
+            basename_template=f"part-{run_id}-{chunk_number}-{{i}}.{extension}",
+            existing_data_behavior='overwrite_or_ignore',
+        )
+        total += len(rows)
+        chunk_number += 1
+    return total
+
+def export(directory=EXPORT_DIR, fmt='parquet', full=False, db_name=DB_NAME):
+    """Exports listings and their price history into partitioned Parquet or Arrow IPC files.
+
+    Only rows changed since the previous export to the same directory and
+    format are written, unless `full` is set. Every run adds new files, so a
+    listing changed twice shows up in two of them; readers should keep the row
+    with the latest updated_at per listing_id.
+    """
+    pa = _pyarrow()
+    listings_schema, prices_schema = _schemas(pa)
+    file_format = FORMATS[fmt]
+    target = f"{os.path.abspath(directory)}:{fmt}"
+    run_id = time.strftime('%Y%m%d%H%M%S')
+
+    with sqlite3.connect(db_name) as conn:
+        row = conn.execute('SELECT exported_seq FROM export_state WHERE target = ?', (target,)).fetchone()
+        since = -1 if full or row is None else row[0]
+        # Changes numbered up to the committed value are all committed (see sqlworker.next_change);
+        # a write still open gets a higher number and is left for the next export.
+        until = conn.execute('SELECT value FROM change_sequence').fetchone()[0]
+
+        listings = _export_table(pa, conn, LISTINGS_QUERY, (since, until), listings_schema,
+                                 os.path.join(directory, 'listings'), file_format, run_id)
+        prices = _export_table(pa, conn, PRICES_QUERY, (since, until), prices_schema,
+                               os.path.join(directory, 'listing_prices'), file_format, run_id)
+
+        conn.execute('''
+            INSERT INTO export_state (target, exported_until, exported_seq) VALUES (?, CURRENT_TIMESTAMP, ?)
+            ON CONFLICT (target) DO UPDATE SET
+                exported_until = excluded.exported_until,
+                exported_seq = excluded.exported_seq
+        ''', (target, until))
+        conn.commit()
+
+    print(f"Exported {listings} listings and {prices} price observations to {directory} ({fmt})")
+    return listings, prices
+
+def main():
+    parser = argparse.ArgumentParser(description="Export listings.db for the Power BI report.")
+    parser.add_argument('--dir', default=EXPORT_DIR, help="output directory")
+    parser.add_argument('--format', choices=sorted(FORMATS), default='parquet')
+    parser.add_argument('--full', action='store_true', help="export every row, not only the changed ones")
+    args = parser.parse_args()
+    export(args.dir, args.format, args.full)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+import http_client
+import metrics
+
+DEFAULT_HOST_CONCURRENCY = http_client.DEFAULT_POOL_SIZE
+
+# Per-host overrides for the number of requests in flight at once. Shared with
+# the connection pool sizes so no request ever waits for a free connection.
+host_concurrency = http_client.host_pool_size
+
+class FetchEngine:
+    """Fetches pages concurrently, never exceeding the per-host concurrency cap.
+
+    The engine has to be created inside the event loop that uses it, since the
+    per-host semaphores are bound to that loop. One engine can serve several
+    portals; `headers` passed to fetch() replace the engine's defaults.
+    """
+
+    def __init__(self, headers=None, concurrency=None, limits=None, getter=None):
+        self.headers = headers or {}
+        self.getter = getter or http_client.fetch
+        self.concurrency = concurrency or DEFAULT_HOST_CONCURRENCY
+        self.limits = dict(host_concurrency)
+        if limits:
+            self.limits.update(limits)
+        self._semaphores = {}
+        self._executor = ThreadPoolExecutor(max_workers=sum(self.limits.values()) + self.concurrency)
+
+    def _semaphore(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.limits.get(host, self.concurrency))
+        return self._semaphores[host]
+
+    def _get(self, url, headers):
+        return self.getter(url, headers=headers or self.headers)
+
+    async def fetch(self, url, headers=None):
+        loop = asyncio.get_running_loop()
+        async with self._semaphore(url):
+            with metrics.timer('scraper_fetch_seconds', host=urlsplit(url).netloc):
+                try:
+                    return await loop.run_in_executor(self._executor, self._get, url, headers)
+                except requests.exceptions.RequestException as e:
+                    print(f"Request to {url} failed: {e}")
+                    return None
+
+    async def fetch_pages(self, urls, prefetched=None, headers=None):
+        """Yields (page, response) pairs in completion order for a {page: url} mapping.
+
+        Responses already in `prefetched` ({page: response}) are yielded first
+        instead of being downloaded again.
+        """
+        async def fetch_one(page, url):
+            return page, await self.fetch(url, headers)
+
+        prefetched = prefetched or {}
+        for page, response in prefetched.items():
+            yield page, response
+        urls = {page: url for page, url in urls.items() if page not in prefetched}
+        tasks = [asyncio.ensure_future(fetch_one(page, url)) for page, url in urls.items()]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+
+CACHE_DIR = ".http_cache"
+DEFAULT_TTL = 6 * 3600
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+class ResponseCache:
+    """On-disk cache of successful GET responses, keyed by URL.
+
+    Each entry is a body file plus a JSON sidecar holding the validators
+    (ETag / Last-Modified) and the time it was last confirmed by the server.
+    Entries younger than `ttl` are served without touching the network, older
+    ones are revalidated with a conditional request. When the cache grows past
+    `max_bytes` the least recently used entries are evicted.
+
+    In `offline` mode every request is answered from the cache (504 on a miss),
+    which allows re-running the parsers against stored pages.
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.directory, key[:2], key)
+        return base + '.body', base + '.json'
+
+    def load(self, url):
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+            os.utime(meta_path)  # mtime doubles as the LRU clock
+        except (OSError, ValueError):
+            return None
+        meta['body'] = body
+        return meta
+
+    def is_fresh(self, entry):
+        return time.time() - entry['checked_at'] < self.ttl
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, response):
+        body_path, meta_path = self._paths(url)
+        meta = {
+            'url': url,
+            'headers': dict(response.headers),
+            'encoding': response.encoding,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'checked_at': time.time(),
+        }
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        old_size = self._entry_size(body_path, meta_path)
+        self._write(body_path, response.content)
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+        self._grow(self._entry_size(body_path, meta_path) - old_size)
+
+    def revalidated(self, url, entry):
+        """Marks an entry as confirmed by a 304 answer."""
+        _, meta_path = self._paths(url)
+        meta = {k: v for k, v in entry.items() if k != 'body'}
+        meta['checked_at'] = time.time()
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def to_response(self, url, entry, unchanged):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(entry.get('headers') or {})
+        response.encoding = entry.get('encoding')
+        response._content = entry['body']
+        response.from_cache = True
+        response.unchanged = unchanged
+        return response
+
+    def miss_response(self, url):
+        response = requests.Response()
+        response.status_code = 504
+        response.url = url
+        response._content = b''
+        response.from_cache = True
+        response.unchanged = False
+        return response
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _entry_size(self, body_path, meta_path):
+        size = 0
+        for path in (body_path, meta_path):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def _entries(self):
+        """Returns [(last_used, size, body_path, meta_path)] for every entry."""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                meta_path = os.path.join(root, name)
+                body_path = meta_path[:-len('.json')] + '.body'
+                try:
+                    last_used = os.path.getmtime(meta_path)
+                except OSError:
+                    continue
+                entries.append((last_used, self._entry_size(body_path, meta_path), body_path, meta_path))
+        return entries
+
+    def _grow(self, delta):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry[1] for entry in self._entries())
+            else:
+                self._size += delta
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop the least recently used entries until the cache is at 90% of its limit.
+        target = self.max_bytes * 0.9
+        for _, size, body_path, meta_path in sorted(self._entries()):
+            if self._size <= target:
+                break
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size -= size
+
+    def iter_urls(self, prefix=''):
+        """Yields the URLs of all stored pages starting with `prefix`."""
+        for _, _, _, meta_path in self._entries():
+            try:
+                with open(meta_path, encoding='utf-8') as f:
+                    url = json.load(f)['url']
+            except (OSError, ValueError, KeyError):
+                continue
+            if url.startswith(prefix):
+                yield url
@@ -0,0 +1,140 @@
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from http_cache import ResponseCache
+import metrics
+import ratelimit
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TIMEOUT = 30
+
+# Keep-alive connections kept open per host; should match the fetch concurrency.
+host_pool_size = {
+    'www.otodom.pl': 4,
+    'www.olx.pl': 4,
+    'ogloszenia.trojmiasto.pl': 2,
+}
+
+_sessions = {}
+_lock = threading.Lock()
+
+# Response cache consulted by get(); set to None to always hit the network.
+cache = ResponseCache()
+
+def _new_session(scheme, host):
+    session = requests.Session()
+    # ACCEPT_ENCODING advertises br/zstd only when urllib3 can decode them.
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    pool_size = host_pool_size.get(host, DEFAULT_POOL_SIZE)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount(f"{scheme}://{host}", adapter)
+    return session
+
+def session_for(url):
+    """Returns the pooled session for the url's host, creating it on first use."""
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = _new_session(*key)
+    return session
+
+def _send(session, url, headers, timeout):
+    """Sends one request, paced and tuned by the host's adaptive rate limiter."""
+    host = urlsplit(url).netloc
+    limiter = ratelimit.limiter_for(host)
+    limiter.acquire()
+    started = time.monotonic()
+    try:
+        response = session.get(url, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        latency = time.monotonic() - started
+        metrics.observe('scraper_request_seconds', latency, host=host)
+        metrics.inc('scraper_http_responses_total', host=host, status=type(e).__name__)
+        if isinstance(e, requests.exceptions.Timeout):
+            limiter.observe(503, latency)
+        raise
+    latency = time.monotonic() - started
+    limiter.observe(response.status_code, latency, ratelimit.retry_after(response))
+    metrics.observe('scraper_request_seconds', latency, host=host)
+    metrics.inc('scraper_http_responses_total', host=host, status=response.status_code)
+    metrics.inc('scraper_downloaded_bytes_total', len(response.content), host=host)
+    return response
+
+def get(url, headers=None, timeout=DEFAULT_TIMEOUT):
+    """GETs the url through the pooled session and the response cache.
+
+    Responses served from the cache carry `from_cache = True`; `unchanged` is
+    set when the cached copy is still fresh or the server answered 304, so the
+    caller can skip parsing a page it has already processed.
+    """
+    session = session_for(url)
+    if cache is None:
+        response = _send(session, url, headers, timeout)
+        response.from_cache = response.unchanged = False
+        return response
+
+    host = urlsplit(url).netloc
+    entry = cache.load(url)
+    if cache.offline:
+        metrics.inc('scraper_cache_responses_total', host=host, result='offline' if entry else 'offline_miss')
+        return cache.to_response(url, entry, unchanged=False) if entry else cache.miss_response(url)
+    if entry and cache.is_fresh(entry):
+        metrics.inc('scraper_cache_responses_total', host=host, result='fresh')
+        return cache.to_response(url, entry, unchanged=True)
+
+    request_headers = dict(headers or {})
+    if entry:
+        request_headers.update(cache.conditional_headers(entry))
+    response = _send(session, url, request_headers, timeout)
+    if response.status_code == 304 and entry:
+        cache.revalidated(url, entry)
+        metrics.inc('scraper_cache_responses_total', host=host, result='revalidated')
+        return cache.to_response(url, entry, unchanged=True)
+    if response.status_code == 200:
+        cache.store(url, response)
+    response.from_cache = response.unchanged = False
+    return response
+
+def fetch(url, headers=None, policy=None):
+    """get() with the shared retry policy applied.
+
+    Connection errors, timeouts and retryable statuses are retried with jittered
+    backoff (or the server's Retry-After) while the host's retry budget lasts.
+    Returns the last response, or None if no response was ever received.
+    """
+    policy = policy or ratelimit.default_policy
+    host = urlsplit(url).netloc
+    budget = policy.budget_for(host)
+    response = None
+    for attempt in range(policy.retries + 1):
+        budget.record_request()
+        try:
+            response = get(url, headers=headers)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            print(f"Request to {url} failed: {e}")
+            response = None
+        # An offline cache miss (504) would be answered the same way again.
+        if not policy.should_retry(response) or getattr(response, 'from_cache', False):
+            return response
+        if attempt == policy.retries or not budget.try_spend():
+            break
+        delay = policy.delay(attempt, response)
+        status = response.status_code if response is not None else "no response"
+        metrics.inc('scraper_retries_total', host=host)
+        print(f"Retrying {url} in {delay:.1f} seconds ({status}, attempt {attempt + 1}/{policy.retries})")
+        time.sleep(delay)
+    print(f"Failed to fetch {url} after {attempt + 1} attempts.")
+    return response
+
+def close():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -1,78 +1,84 @@
 class ListingValidationError(Exception):
     pass
 
-class Listing:
-    def __init__(self, title, price, city, district, area, url):
-        self.title = title
-        self.price = price
-        self.city = city
-        self.district = district
-        self.area = area
-        self.url = url
-
-    @property
-    def title(self):
-        return self._title
+# Spaces are dropped and decimal commas become dots in a single translate() pass.
+_NUMBER_TABLE = str.maketrans({" ": None, ",": "."})
 
-    @title.setter
-    def title(self, value):
-        self._title = str(value).strip() if value else None
+def _text(value):
+    return str(value).strip() if value else None
 
-    @property
-    def price(self):
-        return self._price
-
-    @price.setter
-    def price(self, value):
+def _price(value):
+    if value is None or value == "":
+        return None
+    try:
+        # The scrapers mostly hand over already clean numbers, so try those first.
         try:
-            if value is None or value == "":
-                self._price = None
-                return
-            self._price = int(float(str(value).replace(" ", "").replace("zł", "").replace(",", ".").strip()))
-            if self._price < 0:
-                raise ListingValidationError("Price cannot be negative")
+            price = int(float(value))
         except ValueError:
-            raise ListingValidationError(f"Invalid price format: {value}")
+            price = int(float(str(value).translate(_NUMBER_TABLE).replace("zł", "").strip()))
+    except ValueError:
+        raise ListingValidationError(f"Invalid price format: {value}")
+    if price < 0:
+        raise ListingValidationError("Price cannot be negative")
+    return price
 
-    @property
-    def city(self):
-        return self._city
+def _area(value):
+    if value is None:
+        return None
+    try:
+        try:
+            area = float(value)
+        except ValueError:
+            area = float(str(value).replace("m²", "").translate(_NUMBER_TABLE).replace("m2", "").strip())
+    except ValueError:
+        raise ListingValidationError(f"Invalid area format: {value}")
+    if area <= 0:
+        raise ListingValidationError("Area must be positive")
+    return area
 
-    @city.setter
-    def city(self, value):
-        self._city = str(value).strip() if value else None
+class Listing:
+    __slots__ = ("title", "price", "city", "district", "area", "url")
 
-    @property
-    def district(self):
-        return self._district
+    def __init__(self, title, price, city, district, area, url):
+        self.title = _text(title)
+        self.price = _price(price)
+        self.city = _text(city)
+        self.district = _text(district)
+        self.area = _area(area)
+        self.url = _text(url)
 
-    @district.setter
-    def district(self, value):
-        self._district = str(value).strip() if value else None
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds listings from a page of (title, price, city, district, area, url) tuples."""
+        new = cls.__new__
+        listings = []
+        for title, price, city, district, area, url in rows:
+            listing = new(cls)
+            listing.title = _text(title)
+            listing.price = _price(price)
+            listing.city = _text(city)
+            listing.district = _text(district)
+            listing.area = _area(area)
+            listing.url = _text(url)
+            listings.append(listing)
+        return listings
 
-    @property
-    def area(self):
-        return self._area
+    @classmethod
+    def from_valid_rows(cls, rows):
+        """Like from_rows, but leaves out rows that fail validation (e.g. "Zapytaj o cenę").
 
-    @area.setter
-    def area(self, value):
+        Returns (listings, number of rows left out).
+        """
         try:
-            if value is None:
-                self._area = None
-                return
-            self._area = float(str(value).replace(",", ".").replace("m²", "").replace(" ", "").replace("m2", "").strip())
-            if self._area <= 0:
-                raise ListingValidationError("Area must be positive")
-        except ValueError:
-            raise ListingValidationError(f"Invalid area format: {value}")
-        
-    @property
-    def url(self):
-        return self._url
-    
-    @url.setter
-    def url(self, value):
-        self._url = str(value).strip() if value else None
+            return cls.from_rows(rows), 0
+        except ListingValidationError:
+            listings = []
+            for row in rows:
+                try:
+                    listings.append(cls(*row))
+                except ListingValidationError:
+                    pass
+            return listings, len(rows) - len(listings)
 
     def __str__(self):
         return f"{self.title} | {self.price} zł | {self.city} | {self.district} | {self.area} m²"
@@ -87,4 +93,4 @@ class Listing:
             "city": self.city,
             "district": self.district,
             "area": self.area
-        }
\ No newline at end of file
+        }
@@ -0,0 +1,224 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Where the metrics of a run go; all three are optional.
+#   SCRAPER_METRICS_FILE  written at the end of the run: Prometheus text for *.prom, JSON otherwise
+#   SCRAPER_METRICS_PORT  serves the Prometheus text on http://localhost:PORT/metrics while crawling
+#   SCRAPER_PROFILE       cProfile statistics of the event loop thread, readable with pstats/snakeviz
+METRICS_FILE_ENV = 'SCRAPER_METRICS_FILE'
+METRICS_PORT_ENV = 'SCRAPER_METRICS_PORT'
+PROFILE_ENV = 'SCRAPER_PROFILE'
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'scraper_request_seconds': "Duration of single HTTP requests, by host.",
+    'scraper_fetch_seconds': "Time to get one page including rate limiting and retries, by host.",
+    'scraper_parse_seconds': "Time parse_page spent on one page in the parser pool, by portal.",
+    'scraper_normalize_seconds': "Time to turn one page of rows into Listing objects, by portal.",
+    'scraper_db_transaction_seconds': "Duration of database write transactions.",
+    'scraper_http_responses_total': "HTTP responses received, by host and status code.",
+    'scraper_downloaded_bytes_total': "Response body bytes downloaded, by host.",
+    'scraper_retries_total': "Requests retried, by host.",
+    'scraper_cache_responses_total': "Responses served from the HTTP cache, by host and result.",
+    'scraper_listings_total': "Listings scraped, by portal.",
+    'scraper_db_listings_total': "Listings written to the database, by portal and result.",
+    'scraper_db_failed_listings_total': "Listings lost to failed database transactions.",
+    'scraper_details_total': "Detail pages processed by enrich.py, by portal and result.",
+    'scraper_listings_per_second': "Listings scraped per second of the run, by portal.",
+    'scraper_run_seconds': "Seconds since the metrics were started.",
+}
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Thread-safe counters and latency histograms, keyed by name and labels."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self._counters.clear()
+            self._histograms.clear()
+
+    def inc(self, name, amount=1, **labels):
+        key = _key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = _key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def _gauges(self):
+        elapsed = time.monotonic() - self.started
+        gauges = {'scraper_run_seconds': {(): elapsed}}
+        listings = self._counters.get('scraper_listings_total', {})
+        if listings and elapsed > 0:
+            gauges['scraper_listings_per_second'] = {key: count / elapsed for key, count in listings.items()}
+        return gauges
+
+    def snapshot(self):
+        """Returns all metrics as plain, JSON serializable data."""
+        with self._lock:
+            data = {'counters': {}, 'histograms': {}, 'gauges': {}}
+            for name, series in self._counters.items():
+                data['counters'][name] = [{'labels': dict(key), 'value': value} for key, value in series.items()]
+            for name, series in self._histograms.items():
+                data['histograms'][name] = [{
+                    'labels': dict(key),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': dict(zip([*map(str, LATENCY_BUCKETS), '+Inf'], histogram.counts)),
+                } for key, histogram in series.items()]
+            for name, series in self._gauges().items():
+                data['gauges'][name] = [{'labels': dict(key), 'value': value} for key, value in series.items()]
+            return data
+
+    def prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def header(name, kind):
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                header(name, 'counter')
+                lines.extend(f"{name}{_format_labels(key)} {value}" for key, value in series.items())
+            for name, series in sorted(self._histograms.items()):
+                header(name, 'histogram')
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip([*map(str, LATENCY_BUCKETS), '+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+            for name, series in sorted(self._gauges().items()):
+                header(name, 'gauge')
+                lines.extend(f"{name}{_format_labels(key)} {value}" for key, value in series.items())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes the metrics to `path`: Prometheus text for *.prom files, JSON otherwise."""
+        with open(path, 'w', encoding='utf-8') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=2)
+        print(f"Metrics written to {path}")
+
+registry = Metrics()
+
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+def serve(port, metrics=registry):
+    """Serves the Prometheus text on /metrics from a daemon thread; returns the server."""
+    # Imported here, like cProfile in run(), to keep them off the startup path of runs that do not use them.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving metrics on http://localhost:{server.server_address[1]}/metrics")
+    return server
+
+@contextmanager
+def run():
+    """Wraps a whole crawl: serves, profiles and finally writes the metrics as configured.
+
+    The profile covers the thread that entered run(), which runs the event
+    loop and with it all the crawling. The download threads, the database
+    writer and the parser pool processes are not profiled; their time shows
+    up in the scraper_request_seconds, scraper_db_transaction_seconds and
+    scraper_parse_seconds histograms instead.
+    """
+    registry.reset()
+    server = None
+    port = os.environ.get(METRICS_PORT_ENV)
+    if port:
+        server = serve(int(port))
+    profile_path = os.environ.get(PROFILE_ENV)
+    profile = None
+    if profile_path:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        yield registry
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(profile_path)
+            print(f"Profile written to {profile_path}")
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        path = os.environ.get(METRICS_FILE_ENV)
+        if path:
+            registry.write(path)
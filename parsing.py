@@ -0,0 +1,101 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import metrics
+
+def _default_parser():
+    try:
+        import lxml  # noqa: F401
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+# BeautifulSoup tree builder; lxml is several times faster than html.parser.
+PARSER = os.environ.get('SCRAPER_HTML_PARSER') or _default_parser()
+
+def _json_loads():
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        return json.loads
+
+# Decodes JSON from str or bytes; orjson is several times faster than json when installed.
+loads_json = _json_loads()
+
+# bs4 is imported on first use: a crawl only parses in the pool processes, so the
+# main process never needs it, and neither do the commands that do not parse.
+
+@lru_cache(maxsize=None)
+def only(*rules):
+    """Builds a SoupStrainer keeping just the elements matching one of the rules.
+
+    Each rule is a (tag, attribute, value) triple; for `class` the value has to
+    be one of the element's classes, for other attributes it must match exactly.
+    Everything outside the matched elements is never turned into a tree. The
+    strainer is built once per set of rules.
+    """
+    from bs4 import SoupStrainer
+
+    def match(name, attrs):
+        for tag, attr, value in rules:
+            if name != tag:
+                continue
+            actual = attrs.get(attr)
+            if actual is None:
+                continue
+            if attr == 'class':
+                classes = actual.split() if isinstance(actual, str) else actual
+                if value in classes:
+                    return True
+            elif actual == value:
+                return True
+        return False
+    return SoupStrainer(match)
+
+def make_soup(content, strainer=None):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(content, PARSER, parse_only=strainer)
+
+# Worker processes running the per-portal parse_page functions.
+PARSE_WORKERS = os.cpu_count() or 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, because the pool starts while the database writer and asyncio.to_thread workers are
+            # running; a forked child could inherit a lock one of those threads was holding
+            _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def _timed(parse_page, content):
+    started = time.perf_counter()
+    result = parse_page(content)
+    return result, time.perf_counter() - started
+
+async def parse_in_pool(parse_page, content, portal=None):
+    """Runs parse_page(content) in a worker process, leaving the event loop free to fetch.
+
+    The time spent parsing is measured in the worker, so it does not include
+    waiting for a free one, and recorded under `portal`.
+    """
+    loop = asyncio.get_running_loop()
+    result, seconds = await loop.run_in_executor(_get_pool(), _timed, parse_page, content)
+    metrics.observe('scraper_parse_seconds', seconds, portal=portal or parse_page.__module__)
+    return result
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
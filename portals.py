@@ -0,0 +1,175 @@
+import importlib
+import re
+from functools import partial
+from parsing import loads_json, make_soup, only
+
+# Modules declaring the portals; each one registers its Portal when imported.
+PORTAL_MODULES = ['scraper_otodom', 'scraper_olx', 'scraper_trojmiasto']
+
+registry = {}
+
+class Field:
+    """One value read from a listing card: the text (or `attr`) of the first `selector` match.
+
+    The value is stripped and passed through `clean`; a card without a match
+    yields None.
+    """
+
+    def __init__(self, selector, attr=None, clean=None):
+        self.selector = selector
+        self.attr = attr
+        self.clean = clean
+
+    def __call__(self, card):
+        elem = card.select_one(self.selector)
+        if elem is None:
+            return None
+        value = elem.get(self.attr) if self.attr else elem.text
+        if value is None:
+            return None
+        value = value.strip()
+        return self.clean(value) if self.clean else value
+
+class Pagination:
+    """How a results page tells the number of pages.
+
+    The (tag, attribute, value) rule selects the pagination elements. Without
+    `page_attr` the highest number among their texts is the last page,
+    otherwise the last page is stored in that attribute of the first match.
+    """
+
+    def __init__(self, rule, page_attr=None):
+        self.rule = rule
+        self.page_attr = page_attr
+
+    def max_page(self, soup):
+        tag, attr, value = self.rule
+        if self.page_attr:
+            elem = soup.find(tag, attrs={attr: value})
+            if elem is not None and self.page_attr in elem.attrs:
+                return int(elem[self.page_attr])
+            return 1
+        max_page = 1
+        for elem in soup.find_all(tag, attrs={attr: value}):
+            try:
+                max_page = max(max_page, int(elem.text.strip()))
+            except ValueError:
+                continue
+        return max_page
+
+class EmbeddedData:
+    """JSON payload a server-rendered page embeds for its scripts (e.g. Next.js' __NEXT_DATA__).
+
+    `pattern` is a bytes regex whose first group captures the JSON; with
+    `quoted` the JSON is itself a JSON string literal to be decoded first.
+    `extract(data)` returns `(max_page, rows)` like Portal.parse, or None when
+    the payload does not contain the listings. Reading the payload skips
+    building the HTML tree, which is most of the cost of parsing a page.
+    """
+
+    def __init__(self, pattern, extract, quoted=False):
+        self.pattern = re.compile(pattern, re.S)
+        self.extract = extract
+        self.quoted = quoted
+
+    def parse(self, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        match = self.pattern.search(content)
+        if match is None:
+            return None
+        try:
+            data = loads_json(match.group(1))
+            if self.quoted:
+                data = loads_json(data)
+            return self.extract(data)
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            # A payload laid out differently than expected; the selectors still work.
+            return None
+
+def next_data(extract):
+    """EmbeddedData reading the <script id="__NEXT_DATA__"> payload of a Next.js page."""
+    return EmbeddedData(rb'<script id="__NEXT_DATA__"[^>]*>(.*?)</script>', extract)
+
+class Portal:
+    """Declarative description of a listings portal, crawled by crawler.crawl_city.
+
+    - `cities` maps a city to its results URL, which ends right before the page number,
+    - `cards` is the (tag, attribute, value) rule of a listing card,
+    - `fields` maps title, price, location, area and url to a Field or to a
+      plain function of the card,
+    - `location(text)` splits the location field into (city, district),
+    - `embedded`, an optional EmbeddedData, is tried before the selectors,
+    - `details(content)`, optional, reads a detail page into a dict with any
+      of rooms, floor, build_year, latitude and longitude (see enrich.py).
+
+    Only the cards and the pagination elements are parsed from a page.
+    """
+
+    def __init__(self, name, label, cities, cards, fields, pagination, location, headers=None,
+                 first_page=1, sort_newest=None, embedded=None, details=None):
+        self.name = name
+        self.label = label
+        self.cities = cities
+        self.cards = cards
+        self.fields = fields
+        self.pagination = pagination
+        self.location = location
+        self.headers = headers or {}
+        self.first_page = first_page
+        self.sort_newest = sort_newest
+        self.embedded = embedded
+        self.details = details
+        # Picklable, so pages can be parsed in the parser pool.
+        self.parse_page = partial(parse_page, name)
+        self.parse_details = partial(parse_details, name)
+
+    @property
+    def strainer(self):
+        return only(self.cards, self.pagination.rule)
+
+    def max_page(self, soup):
+        return self.pagination.max_page(soup)
+
+    def extract(self, card):
+        fields = self.fields
+        location = fields['location'](card)
+        city, district = self.location(location) if location else (None, None)
+        return (fields['title'](card), fields['price'](card), city, district, fields['area'](card), fields['url'](card))
+
+    def parse(self, content):
+        """Returns the number of pages and (title, price, city, district, area, url) of every card."""
+        if self.embedded is not None:
+            parsed = self.embedded.parse(content)
+            if parsed is not None:
+                return parsed
+        return self.parse_html(content)
+
+    def parse_html(self, content):
+        soup = make_soup(content, self.strainer)
+        tag, attr, value = self.cards
+        return self.max_page(soup), [self.extract(card) for card in soup.find_all(tag, attrs={attr: value})]
+
+def register(portal):
+    registry[portal.name] = portal
+    return portal
+
+def load():
+    """Imports every portal module and returns the registry."""
+    for module in PORTAL_MODULES:
+        importlib.import_module(module)
+    return registry
+
+def get(name):
+    if name not in registry:
+        load()
+    try:
+        return registry[name]
+    except KeyError:
+        raise KeyError(f"Unknown portal {name!r}, known portals: {', '.join(sorted(registry))}") from None
+
+def parse_page(name, content):
+    return get(name).parse(content)
+
+def parse_details(name, content):
+    return get(name).details(content)
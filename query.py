@@ -0,0 +1,70 @@
+import argparse
+import sqlite3
+from aggregates import ALL, rebuild_aggregates
+from sqlworker import DB_NAME
+
+# Listing columns returned by find_listings().
+COLUMNS = ('listing_id', 'portal', 'title', 'price', 'city', 'district', 'area', 'url', 'cluster_id', 'updated_at')
+
+def price_stats(portal=None, city=None, by_district=False, db_name=DB_NAME):
+    """Returns the precomputed price per m² statistics as dicts, one per city or per district.
+
+    Without `portal` the statistics cover all portals, without `city` all
+    cities. Listings without a district are grouped under district ''.
+    Percentiles are read from histograms, so they are exact to within
+    aggregates.BUCKET_WIDTH zł/m²; counts and means are exact.
+    """
+    conditions = ['portal = ?', 'district != ?' if by_district else 'district = ?']
+    params = [portal or ALL, ALL]
+    if city is not None:
+        conditions.append('city = ?')
+        params.append(city)
+    with sqlite3.connect(db_name) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f'''
+            SELECT * FROM price_stats WHERE {" AND ".join(conditions)} ORDER BY city, district
+        ''', params).fetchall()
+    return [dict(row) for row in rows]
+
+def find_listings(city=None, district=None, portal=None, min_price=None, max_price=None,
+                  min_area=None, max_area=None, limit=100, db_name=DB_NAME):
+    """Returns listings matching every given filter, cheapest first, as dicts."""
+    conditions = []
+    params = []
+    for column, operator, value in (('city', '=', city), ('district', '=', district), ('page', '=', portal),
+                                    ('price', '>=', min_price), ('price', '<=', max_price),
+                                    ('area', '>=', min_area), ('area', '<=', max_area)):
+        if value is not None:
+            conditions.append(f'{column} {operator} ?')
+            params.append(value)
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    with sqlite3.connect(db_name) as conn:
+        rows = conn.execute(f'''
+            SELECT listing_id, page, title, price, city, district, area, url, cluster_id, updated_at
+            FROM listings {where}
+            ORDER BY price
+            LIMIT ?
+        ''', [*params, limit]).fetchall()
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+def main():
+    parser = argparse.ArgumentParser(description="Price per m² statistics from listings.db.")
+    parser.add_argument('--portal', help="one portal instead of all of them")
+    parser.add_argument('--city')
+    parser.add_argument('--by-district', action='store_true', help="one row per district instead of per city")
+    parser.add_argument('--rebuild', action='store_true', help="recompute the statistics from scratch first")
+    args = parser.parse_args()
+    print_stats(args.portal, args.city, args.by_district, args.rebuild)
+
+def print_stats(portal=None, city=None, by_district=False, rebuild=False, db_name=DB_NAME):
+    if rebuild:
+        with sqlite3.connect(db_name) as conn:
+            rebuild_aggregates(conn.cursor())
+    for row in price_stats(portal, city, by_district, db_name):
+        district = row['district'] if row['district'] != ALL else ''
+        print(f"{row['portal']:<11} {row['city']:<10} {district:<25} {row['listings']:>6} listings  "
+              f"median {row['median_price_per_m2']:>8.0f} zł/m²  "
+              f"p25-p75 {row['p25_price_per_m2']:.0f}-{row['p75_price_per_m2']:.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+DEFAULT_RATE = 2.0
+
+# Starting request rates (requests per second); each limiter adapts from here.
+host_rates = {
+    'www.otodom.pl': 2.0,
+    'www.olx.pl': 2.0,
+    'ogloszenia.trojmiasto.pl': 1.0,
+}
+
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def retry_after(response):
+    """Returns the Retry-After delay of a response in seconds, or None."""
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveRateLimiter:
+    """Token bucket for one host whose rate follows the portal's feedback.
+
+    Every fast successful answer raises the rate by `increase` requests per
+    second, up to `max_rate`. A throttling answer (429/503) cuts it by
+    `decrease` and stops all requests to the host until its Retry-After has
+    passed; slow answers shave the rate a little so latency stays near
+    `latency_target`.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, min_rate=0.2, max_rate=20.0, burst=None,
+                 increase=0.05, decrease=0.5, latency_target=2.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst or max(1.0, rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks the calling thread until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def observe(self, status_code, latency, delay=None):
+        with self._lock:
+            if status_code in THROTTLE_STATUSES:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._tokens = 0.0
+                pause = delay if delay is not None else 1.0 / self.rate
+                self._blocked_until = max(self._blocked_until, time.monotonic() + pause)
+            elif latency > self.latency_target:
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            elif status_code < 400:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            self.burst = max(1.0, self.rate)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter_for(host):
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = AdaptiveRateLimiter(rate=host_rates.get(host, DEFAULT_RATE))
+        return limiter
+
+class RetryBudget:
+    """Caps retries at `ratio` of the requests made, plus `min_retries` spare ones."""
+
+    def __init__(self, ratio=0.2, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def try_spend(self):
+        with self._lock:
+            if self.retries >= self.min_retries + self.ratio * self.requests:
+                return False
+            self.retries += 1
+            return True
+
+class RetryPolicy:
+    """Exponential backoff with full jitter that honours Retry-After."""
+
+    def __init__(self, retries=5, base_delay=1.0, max_delay=60.0, budget_ratio=0.2, min_retries=10):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.min_retries = min_retries
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def budget_for(self, host):
+        with self._lock:
+            budget = self._budgets.get(host)
+            if budget is None:
+                budget = self._budgets[host] = RetryBudget(self.budget_ratio, self.min_retries)
+            return budget
+
+    def should_retry(self, response):
+        return response is None or response.status_code in RETRY_STATUSES
+
+    def delay(self, attempt, response=None):
+        delay = retry_after(response)
+        if delay is not None:
+            return min(delay, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+default_policy = RetryPolicy()
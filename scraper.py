@@ -0,0 +1,149 @@
+"""Single entry point for scheduled and manual runs.
+
+    python scraper.py crawl [--portals olx ...] [--cities gdansk ...] [--incremental] [--enrich] [--offline]
+                            [--dry-run]
+    python scraper.py enrich [--portals olx ...] [--limit N] [--workers N] [--backfill N]
+    python scraper.py export [--dir DIR] [--format parquet|arrow] [--full]
+    python scraper.py stats [--portal olx] [--city gdansk] [--by-district] [--rebuild]
+    python scraper.py coordinate [--portals olx ...] [--cities gdansk ...] [--host 127.0.0.1] [--port 8765]
+                                 [--db listings.db]
+    python scraper.py work --coordinator http://HOST:8765 [--batch N] [--concurrency N] [--rate R]
+
+coordinate and work split a crawl over several machines (see distributed.py):
+one coordinator owns the database and hands out pages, any number of
+workers fetch and parse them. To reach workers on other machines the
+coordinator needs --host and the same SCRAPER_COORDINATOR_TOKEN set on
+every node.
+
+Every command imports only the modules it uses, when it runs, so a short run
+such as one city of one portal starts without loading the rest of the project.
+"""
+import argparse
+import sys
+
+def select(names, cities):
+    """Returns [(portal, [city, ...])] for the requested portals and cities; unknown names raise ValueError."""
+    import portals
+    try:
+        selected = [portals.get(name) for name in names] if names else list(portals.load().values())
+    except KeyError as e:
+        raise ValueError(e.args[0]) from None
+    if cities:
+        known = {city for portal in selected for city in portal.cities}
+        unknown = [city for city in cities if city not in known]
+        if unknown:
+            raise ValueError(f"Unknown cities {', '.join(unknown)}, known cities: {', '.join(sorted(known))}")
+    plan = []
+    for portal in selected:
+        portal_cities = [city for city in portal.cities if not cities or city in cities]
+        if portal_cities:
+            plan.append((portal, portal_cities))
+    return plan
+
+def crawl(args):
+    if args.dry_run:
+        from crawler import newest_first
+        cached = None
+        if args.offline:
+            import http_client
+            cached = list(http_client.cache.iter_urls())
+        for portal, cities in args.plan:
+            for city in cities:
+                base_url = portal.cities[city]
+                if args.incremental:
+                    base_url = newest_first(base_url, portal.sort_newest)
+                line = f"{portal.name:<11} {city:<10} {base_url}{portal.first_page}"
+                if cached is not None:
+                    line += f"  ({sum(url.startswith(base_url) for url in cached)} pages cached)"
+                print(line)
+        return
+    import aio
+    aio.main(args.incremental, [portal.name for portal, _ in args.plan], args.enrich, args.cities, args.offline)
+
+def enrich(args):
+    import enrich
+    enrich.run(args.portals, args.workers, args.limit, args.backfill)
+
+def export(args):
+    import export
+    export.export(args.dir, args.format, args.full)
+
+def stats(args):
+    import query
+    query.print_stats(args.portal, args.city, args.by_district, args.rebuild)
+
+def coordinate(args):
+    import distributed
+    distributed.coordinate(args.plan, args.port, args.db, args.host)
+
+def work(args):
+    import distributed
+    distributed.run_worker(args.coordinator, args.batch, args.concurrency, args.rate)
+
+def build_parser():
+    # Defaults are spelled out here rather than read from the command modules, which are not imported yet.
+    parser = argparse.ArgumentParser(description="Scrape flat listings and work with listings.db.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('crawl', help="crawl the results pages of the portals")
+    command.add_argument('--portals', nargs='+', help="portals to crawl (default: all)")
+    command.add_argument('--cities', nargs='+', help="cities to crawl (default: all of each portal)")
+    command.add_argument('--incremental', action='store_true',
+                         help="newest first, stopping once pages stop bringing changes")
+    command.add_argument('--enrich', action='store_true', help="then fetch details of new and changed listings")
+    command.add_argument('--offline', action='store_true',
+                         help="only replay pages from the response cache, e.g. to re-run changed parsers")
+    command.add_argument('--dry-run', action='store_true',
+                         help="only print the portals, cities and first URLs (with --offline: and the pages cached)")
+    command.set_defaults(run=crawl)
+
+    command = commands.add_parser('enrich', help="fetch detail pages of new and changed listings")
+    command.add_argument('--portals', nargs='+', help="portals to enrich (default: all)")
+    command.add_argument('--limit', type=int, help="at most this many listings")
+    command.add_argument('--workers', type=int, default=8)
+    command.add_argument('--backfill', type=int, metavar='N',
+                         help="first queue up to N listings that never had their details fetched")
+    command.set_defaults(run=enrich)
+
+    command = commands.add_parser('export', help="export listings for the Power BI report")
+    command.add_argument('--dir', default='export', help="output directory")
+    command.add_argument('--format', choices=['arrow', 'parquet'], default='parquet')
+    command.add_argument('--full', action='store_true', help="export every row, not only the changed ones")
+    command.set_defaults(run=export)
+
+    command = commands.add_parser('stats', help="price per m² statistics")
+    command.add_argument('--portal', help="one portal instead of all of them")
+    command.add_argument('--city')
+    command.add_argument('--by-district', action='store_true', help="one row per district instead of per city")
+    command.add_argument('--rebuild', action='store_true', help="recompute the statistics from scratch first")
+    command.set_defaults(run=stats)
+
+    command = commands.add_parser('coordinate', help="hand out the pages of a crawl to workers and store the results")
+    command.add_argument('--portals', nargs='+', help="portals to crawl (default: all)")
+    command.add_argument('--cities', nargs='+', help="cities to crawl (default: all of each portal)")
+    command.add_argument('--host', default='127.0.0.1',
+                         help="address to listen on, e.g. 0.0.0.0 (needs SCRAPER_COORDINATOR_TOKEN)")
+    command.add_argument('--port', type=int, default=8765)
+    command.add_argument('--db', default='listings.db', help="database the results are stored in")
+    command.set_defaults(run=coordinate)
+
+    command = commands.add_parser('work', help="crawl pages handed out by a coordinator")
+    command.add_argument('--coordinator', required=True, help="coordinator URL, e.g. http://10.0.0.1:8765")
+    command.add_argument('--batch', type=int, default=20, help="pages leased and reported at once")
+    command.add_argument('--concurrency', type=int, help="concurrent requests per host")
+    command.add_argument('--rate', type=float, help="starting requests per second per host on this node")
+    command.set_defaults(run=work)
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command in ('crawl', 'enrich', 'coordinate'):
+        try:
+            args.plan = select(args.portals, getattr(args, 'cities', None))
+        except ValueError as e:
+            parser.error(str(e))
+    args.run(args)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,8 +1,6 @@
-import requests
-from bs4 import BeautifulSoup
+import sys
 import csv
-from listing import Listing
-from sqlworker import DatabaseWorker
+from portals import EmbeddedData, Field, Pagination, Portal, register
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36'
@@ -14,6 +12,12 @@ olx_urls = {
     'gdynia': 'https://www.olx.pl/nieruchomosci/mieszkania/sprzedaz/gdynia/?page='
 }
 
+# Newest-first ordering used by incremental crawls.
+sort_newest = 'search%5Border%5D=created_at%3Adesc'
+
+# The page state OLX renders into a JSON string literal for its scripts.
+prerendered_state = rb'window\.__PRERENDERED_STATE__\s*=\s*("(?:[^"\\]|\\.)*")'
+
 def parse_location(location):
     if "-" in location:
         location = location.split("-")[0].strip()
@@ -41,82 +45,66 @@ def extract_url(url):
         return url.replace("/d", "www.olx.pl/d")
     return url
 
-def get_max_page(soup):
-    page_elements = soup.find_all('li', {'data-testid': 'pagination-list-item'})
-    max_page = 1
-    for elem in page_elements:
-        try:
-            page_num = int(elem.text.strip())
-            max_page = max(max_page, page_num)
-        except ValueError:
-            continue
-    return max_page
-
 def save_to_csv(filename, data):
     with open(filename, mode='a', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
         writer.writerows(data)
 
-def scrape_olx_city(city, base_url):
-    print(f"Scraping OLX listings for {city}...")
-    db = DatabaseWorker()
-    all_listings = 0
-    page = 1
-
-    url = f"{base_url}{page}"
-    response = requests.get(url, headers=headers)
-
-    if response.status_code != 200:
-        print(f"Failed to fetch page 1 for {city}. HTTP Status Code: {response.status_code}")
-        return
-
-    soup = BeautifulSoup(response.content, 'html.parser')
-    max_page = get_max_page(soup)
-    print(f"Max pages for {city} on OLX: {max_page}")
-
-    while page <= max_page:
-        print(f"Scraping page {page} for {city}")
-        url = f"{base_url}{page}"
-        response = requests.get(url, headers=headers)
-
-        if response.status_code != 200:
-            print(f"Failed to fetch page {page} for {city}. HTTP Status Code: {response.status_code}")
-            break
-
-        soup = BeautifulSoup(response.content, 'html.parser')
-        listings = soup.find_all('div', class_='css-l9drzq')
-
-        if not listings:
-            print(f"No more listings found on page {page} for {city}.")
-            break
-
-        page_data = []
-        for listing in listings:
-            title_elem = listing.select_one('h4.css-1s3qyje')
-            price_elem = listing.select_one('p[data-testid="ad-price"].css-13afqrm')
-            location_elem = listing.select_one('p.css-1mwdrlh')
-            area_elem = listing.select_one('span.css-1cd0guq')
-            url_elem = listing.select_one('a.css-qo0cxu')
-
-            title = title_elem.text.strip() if title_elem else None
-            price = extract_price(price_elem.text.strip()) if price_elem else None
-            location = location_elem.text.strip() if location_elem else None
-            area = extract_area(area_elem.text.strip()) if area_elem else None
-            listing_url = extract_url(url_elem.attrs['href'])
-
-            city_name, district = parse_location(location)
-            temp_listing = Listing(title, price, city_name, district, area, listing_url)
-
-            page_data.append(temp_listing)
-        db.upsert_listings(page_data, "olx")
-        all_listings += len(page_data)
-        page += 1
-
-    print(f"Finished scraping OLX for {city}. Total listings: {all_listings}")
-
-def main():
-    for city, base_url in olx_urls.items():
-        scrape_olx_city(city, base_url)
+def _area(params):
+    for param in params or []:
+        if param.get('key') == 'm':
+            return param.get('normalizedValue')
+    return None
+
+def embedded_listings(state):
+    """Reads the listings from the state OLX prerenders into window.__PRERENDERED_STATE__."""
+    listing = state['listing']['listing']
+    rows = []
+    for ad in listing['ads']:
+        location = ad.get('location') or {}
+        price = ((ad.get('price') or {}).get('regularPrice') or {}).get('value')
+        url = ad.get('url')
+        if url and url.startswith("https://www.olx.pl/d"):
+            url = url[len("https://"):]
+        rows.append((ad.get('title'), price, location.get('cityName'), location.get('districtName'),
+                     _area(ad.get('params')), url))
+    return listing.get('totalPages') or 1, rows
+
+def embedded_details(state):
+    """Reads rooms, floor and coordinates from an OLX offer page; OLX has no build year."""
+    ad = state['ad']['ad']
+    params = {param.get('key'): param.get('normalizedValue') for param in ad.get('params') or []}
+    location = ad.get('map') or {}
+    return {
+        'rooms': params.get('rooms'),
+        'floor': params.get('floor_select'),
+        'latitude': location.get('lat'),
+        'longitude': location.get('lon'),
+    }
+
+portal = register(Portal(
+    name="olx",
+    label="OLX",
+    cities=olx_urls,
+    headers=headers,
+    sort_newest=sort_newest,
+    cards=('div', 'class', 'css-l9drzq'),
+    pagination=Pagination(('li', 'data-testid', 'pagination-list-item')),
+    fields={
+        'title': Field('h4.css-1s3qyje'),
+        'price': Field('p[data-testid="ad-price"].css-13afqrm', clean=extract_price),
+        'location': Field('p.css-1mwdrlh'),
+        'area': Field('span.css-1cd0guq', clean=extract_area),
+        'url': Field('a.css-qo0cxu', attr='href', clean=extract_url),
+    },
+    location=parse_location,
+    embedded=EmbeddedData(prerendered_state, embedded_listings, quoted=True),
+    details=EmbeddedData(prerendered_state, embedded_details, quoted=True).parse,
+))
+
+def main(incremental=False):
+    import aio
+    aio.main(incremental, names=[portal.name])
 
 if __name__ == "__main__":
-    main()
+    main(incremental="--incremental" in sys.argv)
@@ -1,9 +1,7 @@
-import requests
-from bs4 import BeautifulSoup
+import sys
 import csv
 import re
-from listing import Listing
-from sqlworker import DatabaseWorker
+from portals import Field, Pagination, Portal, next_data, register
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
@@ -15,6 +13,9 @@ cities = {
     'gdynia': 'https://www.otodom.pl/pl/wyniki/sprzedaz/mieszkanie/pomorskie/gdynia?page='
 }
 
+# Newest-first ordering used by incremental crawls.
+sort_newest = 'by=LATEST&direction=DESC'
+
 def parse_location(location):
     parts = location.split(", ")
     if location.lower().startswith("ul."):
@@ -32,18 +33,6 @@ def save_to_csv(city, data):
         for row in data:
             writer.writerow(row)
 
-def get_max_page(soup):
-    """Znajduje maksymalną liczbę stron z elementów `li` o klasie `css-43nhzf`."""
-    page_elements = soup.find_all('li', class_='css-43nhzf')
-    max_page = 1
-    for elem in page_elements:
-        try:
-            page_num = int(elem.text.strip())
-            max_page = max(max_page, page_num)
-        except ValueError:
-            continue
-    return max_page
-
 def clean_price(price):
     """Funkcja do usuwania złotówek i zostawiania tylko cyfr."""
     cleaned_price = re.sub(r'\D', '', price)
@@ -54,77 +43,80 @@ def clean_surface(surface):
     cleaned_surface = surface.replace(' m²', '').strip()
     return cleaned_surface if cleaned_surface else ''
 
-def scrape_city(city, base_url):
-    print(f"Scraping listings for {city}...")
-    db = DatabaseWorker()
-    all_listings = 0
-    page = 1
-
-    first_url = f"{base_url}{page}"
-    response = requests.get(first_url, headers=headers)
-    if response.status_code != 200:
-        print(f"Failed to fetch initial page for {city}. HTTP Status Code: {response.status_code}")
-        return
-
-    soup = BeautifulSoup(response.content, 'html.parser')
-    max_page = get_max_page(soup)
-    print(f"Max pages for {city}: {max_page}")
-
-    while page <= max_page:
-        print(f"Scraping page {page} for {city}")
-        url = f"{base_url}{page}"
-        response = requests.get(url, headers=headers)
-
-        if response.status_code != 200:
-            print(f"Failed to fetch page {page} for {city}. HTTP Status Code: {response.status_code}")
-            break
-
-        soup = BeautifulSoup(response.content, 'html.parser')
-        listings = soup.find_all('article', class_='css-136g1q2')
-
-        if not listings:
-            print(f"No more listings found on page {page} for {city}.")
-            break
-
-        page_data = []
-        for listing in listings:
-            title_elem = listing.find('p', class_='css-u3orbr e1g5xnx10')
-            price_elem = listing.find('span', class_="css-2bt9f1 evk7nst0")
-            location_elem = listing.find('p', class_='css-42r2ms eejmx80')
-            url_elem = listing.find('a', class_='css-16vl3c1 e17g0c820')
-
-            title = title_elem.text.strip() if title_elem else None
-            price = price_elem.text.strip() if price_elem else None
-            location = location_elem.text.strip() if location_elem else None
-            listing_url = url_elem.attrs['href'].replace("/pl", "otodom.pl/pl").strip() if url_elem else None
-
-            dzielnica, miasto, wojewodztwo = parse_location(location)
-
-            details_section = listing.find('dl', class_='css-12dsp7a')
-            surface_area = "Brak danych"
-            if details_section:
-                dt_elements = details_section.find_all('dt')
-                dd_elements = details_section.find_all('dd')
-                for dt, dd in zip(dt_elements, dd_elements):
-                    if dt.text.strip() == "Powierzchnia":
-                        surface_area = dd.text.strip()
-                        break
-
-            price = clean_price(price)
-            surface_area = clean_surface(surface_area)
-            temp_listing = Listing(title, price, miasto, dzielnica, surface_area, listing_url)
-
-            page_data.append(temp_listing)
-
-        db.upsert_listings(page_data, "otodom")
-        all_listings += len(page_data)
-
-        page += 1
-
-    print(f"Finished scraping for {city}. Total listings: {all_listings}")
-def main():
-    for city, base_url in cities.items():
-      scrape_city(city, base_url)
+def surface_area(card):
+    details_section = card.find('dl', class_='css-12dsp7a')
+    surface_area = "Brak danych"
+    if details_section:
+        dt_elements = details_section.find_all('dt')
+        dd_elements = details_section.find_all('dd')
+        for dt, dd in zip(dt_elements, dd_elements):
+            if dt.text.strip() == "Powierzchnia":
+                surface_area = dd.text.strip()
+                break
+    return clean_surface(surface_area)
+
+def full_url(href):
+    return href.replace("/pl", "otodom.pl/pl")
+
+def split_location(location):
+    dzielnica, miasto, wojewodztwo = parse_location(location)
+    return miasto, dzielnica
+
+def _district(location):
+    for place in (location.get('reverseGeocoding') or {}).get('locations') or []:
+        if place.get('locationLevel') == 'district':
+            return place.get('name')
+    return None
+
+def embedded_listings(data):
+    """Reads the listings from the search results Otodom embeds in __NEXT_DATA__."""
+    search_ads = data['props']['pageProps']['data']['searchAds']
+    rows = []
+    for item in search_ads['items']:
+        location = item.get('location') or {}
+        city = ((location.get('address') or {}).get('city') or {}).get('name')
+        price = (item.get('totalPrice') or {}).get('value')
+        slug = item.get('slug')
+        url = f"otodom.pl/pl/oferta/{slug}" if slug else None
+        rows.append((item.get('title'), price, city, _district(location), item.get('areaInSquareMeters'), url))
+    return (search_ads.get('pagination') or {}).get('totalPages') or 1, rows
+
+def embedded_details(data):
+    """Reads rooms, floor, build year and coordinates from an Otodom offer page."""
+    ad = data['props']['pageProps']['ad']
+    characteristics = {item.get('key'): item.get('value') for item in ad.get('characteristics') or []}
+    coordinates = (ad.get('location') or {}).get('coordinates') or {}
+    return {
+        'rooms': characteristics.get('rooms_num'),
+        'floor': characteristics.get('floor_no'),
+        'build_year': characteristics.get('build_year'),
+        'latitude': coordinates.get('latitude'),
+        'longitude': coordinates.get('longitude'),
+    }
+
+portal = register(Portal(
+    name="otodom",
+    label="Otodom",
+    cities=cities,
+    headers=headers,
+    sort_newest=sort_newest,
+    cards=('article', 'class', 'css-136g1q2'),
+    pagination=Pagination(('li', 'class', 'css-43nhzf')),
+    fields={
+        'title': Field('p.css-u3orbr.e1g5xnx10'),
+        'price': Field('span.css-2bt9f1.evk7nst0', clean=clean_price),
+        'location': Field('p.css-42r2ms.eejmx80'),
+        'area': surface_area,
+        'url': Field('a.css-16vl3c1.e17g0c820', attr='href', clean=full_url),
+    },
+    location=split_location,
+    embedded=next_data(embedded_listings),
+    details=next_data(embedded_details).parse,
+))
+
+def main(incremental=False):
+    import aio
+    aio.main(incremental, names=[portal.name])
 
 if __name__ == "__main__":
-    main()
+    main(incremental="--incremental" in sys.argv)
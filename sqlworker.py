@@ -1,12 +1,191 @@
+import hashlib
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from typing import List
 from listing import Listing
+from duplicates import index_listings
+from aggregates import PriceDeltas, create_schema, rebuild_aggregates
+import metrics
 
 DB_NAME = "listings.db"
 
-def init_database():
+# Rows per multi-row INSERT; keeps the bound parameters under SQLite's 999 limit.
+UPSERT_CHUNK = 140
+
+# Order in which detail_queue is worked through by enrich.py; lower comes first.
+DETAIL_PRIORITY_NEW = 0
+DETAIL_PRIORITY_CHANGED = 1
+DETAIL_PRIORITY_BACKFILL = 2
+
+def _add_listing_key_index(cursor):
+    # Older databases can hold duplicate (page, title) rows; keep the newest one.
+    cursor.execute('''
+        DELETE FROM listings
+        WHERE title IS NOT NULL AND listing_id NOT IN (
+            SELECT MAX(listing_id) FROM listings GROUP BY page, title
+        )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_listings_page_title ON listings (page, title)')
+
+def _add_crawl_pages(cursor):
+    # Per-page crawl state of the current run of every (portal, city), see checkpoint.py.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS crawl_pages (
+            portal VARCHAR(15) NOT NULL,
+            city VARCHAR(15) NOT NULL,
+            page INTEGER NOT NULL,
+            status VARCHAR(10) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (portal, city, page)
+        )
+    ''')
+
+def _add_listing_prices(cursor):
+    # Price/area history; a row is added only when a listing is new or one of them changed.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS listing_prices (
+            listing_id INTEGER NOT NULL REFERENCES listings (listing_id),
+            price INTEGER,
+            area REAL NULL,
+            observed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listing_prices_listing ON listing_prices (listing_id, observed_at)')
+    # The values already stored become the first observation of every listing.
+    cursor.execute('INSERT INTO listing_prices (listing_id, price, area) SELECT listing_id, price, area FROM listings')
+
+def _add_duplicate_clusters(cursor):
+    # Cross-portal duplicate detection, see duplicates.py.
+    cursor.execute('ALTER TABLE listings ADD COLUMN cluster_id INTEGER NULL')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_cluster ON listings (cluster_id)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS listing_fingerprints (
+            listing_id INTEGER PRIMARY KEY REFERENCES listings (listing_id),
+            portal VARCHAR(15) NOT NULL,
+            block_key TEXT NOT NULL,
+            price INTEGER,
+            area REAL NULL,
+            tokens TEXT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listing_fingerprints_block ON listing_fingerprints (block_key)')
+    rows = cursor.execute('''
+        SELECT page, listing_id, title, price, city, district, area FROM listings ORDER BY listing_id
+    ''').fetchall()
+    for source, *row in rows:
+        index_listings(cursor, source, [row])
+
+def _add_change_tracking(cursor):
+    # Last time a listing was inserted or changed, used by incremental exports (export.py).
+    cursor.execute('ALTER TABLE listings ADD COLUMN updated_at TEXT NULL')
+    cursor.execute('''
+        UPDATE listings SET updated_at = (
+            SELECT MAX(observed_at) FROM listing_prices WHERE listing_prices.listing_id = listings.listing_id
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_updated_at ON listings (updated_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listing_prices_observed_at ON listing_prices (observed_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS export_state (
+            target TEXT PRIMARY KEY,
+            exported_until TEXT NOT NULL
+        )
+    ''')
+
+def _add_price_stats(cursor):
+    # Indexes for filtering listings and the price per m² aggregates, see aggregates.py and query.py.
+    create_schema(cursor)
+    rebuild_aggregates(cursor)
+
+def _add_listing_details(cursor):
+    # Attributes only found on the detail page of a listing, filled in by enrich.py.
+    cursor.execute('ALTER TABLE listings ADD COLUMN rooms INTEGER NULL')
+    cursor.execute('ALTER TABLE listings ADD COLUMN floor INTEGER NULL')
+    cursor.execute('ALTER TABLE listings ADD COLUMN build_year INTEGER NULL')
+    cursor.execute('ALTER TABLE listings ADD COLUMN latitude REAL NULL')
+    cursor.execute('ALTER TABLE listings ADD COLUMN longitude REAL NULL')
+    cursor.execute('ALTER TABLE listings ADD COLUMN details_at TEXT NULL')
+    # Listings whose detail page has to be (re)fetched; write_listings queues new and changed ones.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS detail_queue (
+            listing_id INTEGER PRIMARY KEY REFERENCES listings (listing_id),
+            priority INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            queued_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_detail_queue_priority ON detail_queue (priority, queued_at)')
+
+def _add_page_leases(cursor):
+    # Which worker of a distributed crawl holds a page, and until when (see checkpoint.PageQueue).
+    cursor.execute('ALTER TABLE crawl_pages ADD COLUMN lease_owner TEXT NULL')
+    cursor.execute('ALTER TABLE crawl_pages ADD COLUMN lease_until REAL NULL')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_crawl_pages_status ON crawl_pages (status, page)')
+
+def _add_crawl_page_mode(cursor):
+    # Full or incremental: the two crawl different page orderings, so a run is only resumed in its own mode.
+    cursor.execute("ALTER TABLE crawl_pages ADD COLUMN mode VARCHAR(12) NOT NULL DEFAULT 'full'")
+
+def _add_crawl_run_start(cursor):
+    # When the run a page belongs to started; a run is too old to resume by its start, not its last update.
+    cursor.execute('ALTER TABLE crawl_pages ADD COLUMN run_started_at REAL NULL')
+    cursor.execute('''
+        UPDATE crawl_pages SET run_started_at = (
+            SELECT MIN(run.updated_at) FROM crawl_pages AS run
+            WHERE run.portal = crawl_pages.portal AND run.city = crawl_pages.city
+        )
+    ''')
+
+def _add_change_sequence(cursor):
+    # Numbers every write to listings and listing_prices in commit order, so an export can tell
+    # exactly what it has seen (see export.py); updated_at is stamped before a write commits.
+    cursor.execute('CREATE TABLE IF NOT EXISTS change_sequence (value INTEGER NOT NULL)')
+    cursor.execute('INSERT INTO change_sequence (value) VALUES (1)')
+    cursor.execute('ALTER TABLE listings ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE listing_prices ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE export_state ADD COLUMN exported_seq INTEGER NOT NULL DEFAULT 0')
+    # Rows not yet exported to every target become change 1; a target may get some of them twice.
+    cursor.execute('''
+        UPDATE listings SET change_seq = 1
+        WHERE updated_at > COALESCE((SELECT MIN(exported_until) FROM export_state), '')
+    ''')
+    cursor.execute('''
+        UPDATE listing_prices SET change_seq = 1
+        WHERE observed_at > COALESCE((SELECT MIN(exported_until) FROM export_state), '')
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_change_seq ON listings (change_seq)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_listing_prices_change_seq ON listing_prices (change_seq)')
+
+# Schema migrations, applied in order; the database's user_version counts the ones already done.
+MIGRATIONS = [
+    _add_listing_key_index,
+    _add_crawl_pages,
+    _add_listing_prices,
+    _add_duplicate_clusters,
+    _add_change_tracking,
+    _add_price_stats,
+    _add_listing_details,
+    _add_page_leases,
+    _add_crawl_page_mode,
+    _add_crawl_run_start,
+    _add_change_sequence,
+]
+
+def migrate(conn):
+    cursor = conn.cursor()
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(cursor)
+        cursor.execute(f'PRAGMA user_version = {number}')
+        print(f"Applied database migration {number}: {migration.__name__}")
+    conn.commit()
+
+def init_database(db_name=DB_NAME):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with sqlite3.connect(db_name) as conn:
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -21,41 +200,186 @@ def init_database():
                     url VARCHAR(255) NULL
                 )
             ''')
-            conn.commit()
-            print(f"Database {DB_NAME} initialized successfully")
+            migrate(conn)
+            print(f"Database {db_name} initialized successfully")
             
     except sqlite3.Error as e:
         print(f"Error creating database: {e}")
         raise
 
+def next_change(cursor):
+    """Takes the next change_seq inside the caller's write transaction.
+
+    Writers hold SQLite's write lock from here to their commit, so every
+    number up to the committed value belongs to a committed write.
+    """
+    return cursor.execute('UPDATE change_sequence SET value = value + 1 RETURNING value').fetchone()[0]
+
+def place_key(city, district, url):
+    """Stands in, in the cache, for the stored fields other than price and area."""
+    return hash((city, district, url))
+
+class DedupCache:
+    """LRU map of (source, title) -> (listing_id, price, area, place_key) shared by every DatabaseWorker.
+
+    Titles are stored as 64-bit hashes and each source keeps at most
+    `max_entries` of its most recently used keys; anything evicted is found
+    again through the (page, title) index.
+    """
+
+    def __init__(self, max_entries=100_000):
+        self.max_entries = max_entries
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(title):
+        return int.from_bytes(hashlib.blake2b(title.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def get(self, source, title):
+        key = self._hash(title)
+        with self._lock:
+            entries = self._sources.get(source)
+            if entries is None or key not in entries:
+                return None
+            entries.move_to_end(key)
+            return entries[key]
+
+    def put(self, source, title, value):
+        key = self._hash(title)
+        with self._lock:
+            entries = self._sources.setdefault(source, OrderedDict())
+            entries[key] = value
+            entries.move_to_end(key)
+            if len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def discard(self, source, title):
+        with self._lock:
+            entries = self._sources.get(source)
+            if entries is not None:
+                entries.pop(self._hash(title), None)
+
+dedup_cache = DedupCache()
+
 class DatabaseWorker:
-    def __init__(self):
-        self.db_name = DB_NAME
-        self.existing_records = {}  # {(page, title): listing_id}
-        self._init_cache()
-    
-    def _init_cache(self):
+    def __init__(self, cache=None, db_name=DB_NAME):
+        self.db_name = db_name
+        self.cache = cache or dedup_cache
+        self._lock = threading.Lock()  # upsert_listings may be called from several threads
+
+    def upsert_listings(self, listings: List[Listing], source: str, page_mark=None):
+        """Stores listings; page_mark=(city, page, status) records the crawl page in the same transaction."""
+        with self._lock:
+            updated = inserted = 0
+            touched = []
+            try:
+                with metrics.timer('scraper_db_transaction_seconds'), sqlite3.connect(self.db_name) as conn:
+                    updated, inserted, touched = self.write_listings(conn, listings, source)
+                    if page_mark:
+                        self.mark_pages(conn, [(source, *page_mark)])
+                    conn.commit()
+                metrics.inc('scraper_db_listings_total', updated, portal=source, result='updated')
+                metrics.inc('scraper_db_listings_total', inserted, portal=source, result='inserted')
+            except sqlite3.Error as e:
+                # The rows behind the cached ids were rolled back.
+                self.forget(touched)
+                updated = inserted = 0
+                metrics.inc('scraper_db_failed_listings_total', len(listings))
+                print(f"An error occurred while puting the data into database: {e}")
+            finally:
+                print(f"Updated {updated} and inserted {inserted} listings from {source}")
+
+    def mark_page(self, source: str, city: str, page: int, status: str):
+        with self._lock:
+            with sqlite3.connect(self.db_name, timeout=30) as conn:
+                self.mark_pages(conn, [(source, city, page, status)])
+
+    def mark_pages(self, conn, marks):
+        """Sets the crawl status of (portal, city, page, status) marks without committing."""
+        now = time.time()
+        conn.executemany('''
+            UPDATE crawl_pages
+            SET status = ?, attempts = attempts + 1, updated_at = ?, lease_until = NULL
+            WHERE portal = ? AND city = ? AND page = ?
+        ''', [(status, now, portal, city, page) for portal, city, page, status in marks])
+
+    def lookup(self, conn, source, titles, fill_cache=True):
+        """Returns {title: (listing_id, price, area, place_key)} for the titles already stored for source.
+
+        Cache misses are resolved with one indexed query per chunk of titles.
+        Only the writer may fill the cache with what it read: anyone else
+        reads a snapshot that the writer's own puts may already have replaced.
+        """
+        found = {}
+        missing = []
+        for title in set(titles):
+            if title is None:
+                continue
+            record = self.cache.get(source, title)
+            if record is None:
+                missing.append(title)
+            else:
+                found[title] = record
+        for start in range(0, len(missing), UPSERT_CHUNK):
+            chunk = missing[start:start + UPSERT_CHUNK]
+            placeholders = ", ".join(["?"] * len(chunk))
+            cursor = conn.execute(f'''
+                SELECT listing_id, title, price, area, city, district, url FROM listings
+                WHERE page = ? AND title IN ({placeholders})
+            ''', [source, *chunk])
+            for listing_id, title, price, area, city, district, url in cursor:
+                found[title] = record = (listing_id, price, area, place_key(city, district, url))
+                if fill_cache:
+                    self.cache.put(source, title, record)
+        return found
+
+    def count_changes(self, listings: List[Listing], source: str):
+        """Counts the listings that are new or whose price or area differs from the stored one.
+
+        Runs on the crawl threads, next to the writer, so it leaves the cache alone.
+        """
         with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT listing_id, page, title FROM listings')
-            for listing_id, page, title in cursor.fetchall():
-                self.existing_records[(page, title)] = listing_id
-    
-    def upsert_listings(self, listings: List[Listing], source: str):
-        updates = []
-        inserts = []
-        
+            known = self.lookup(conn, source, [listing.title for listing in listings], fill_cache=False)
+        changed = 0
         for listing in listings:
-            if (source, listing.title) in self.existing_records:
-                updates.append((
-                    listing.price, 
-                    listing.city, 
-                    listing.district, 
-                    listing.area,
-                    listing.url,
-                    self.existing_records[(source, listing.title)]
-                ))
-            else:
+            record = known.get(listing.title)
+            if record is None or (record[1], record[2]) != (listing.price, listing.area):
+                changed += 1
+        return changed
+
+    def write_listings(self, conn, listings: List[Listing], source: str):
+        """Upserts listings on an open connection without committing.
+
+        Only new listings and listings with a changed field are written; each
+        of those is (re)matched against the other portals' listings, has the
+        price_stats of its groups recomputed and is queued for detail
+        enrichment, and those with a new price or area also get a row in
+        listing_prices. Unchanged listings cost nothing but the lookup.
+
+        Returns (updated, inserted, touched_keys); if the surrounding transaction
+        is rolled back, forget(touched_keys) must be called to keep the cache in
+        sync.
+        """
+        # A title seen twice in one batch is written once, with its last values. Listings without
+        # a title are left out: nothing identifies them, so every crawl would store them anew.
+        latest = {listing.title: listing for listing in listings if listing.title is not None}
+
+        touched = [(source, title) for title in latest]
+        try:
+            known = self.lookup(conn, source, list(latest))
+        except Exception:
+            self.forget(touched)
+            raise
+
+        inserts = []
+        updates = []
+        changed = []
+        repriced = set()
+        for listing in latest.values():
+            record = known.get(listing.title)
+            place = place_key(listing.city, listing.district, listing.url)
+            if record is None:
                 inserts.append((
                     source,
                     listing.title,
@@ -65,38 +389,94 @@ class DatabaseWorker:
                     listing.area,
                     listing.url
                 ))
+            elif (record[1], record[2], record[3]) != (listing.price, listing.area, place):
+                if (record[1], record[2]) != (listing.price, listing.area):
+                    repriced.add(record[0])
+                updates.append((
+                    listing.price,
+                    listing.city,
+                    listing.district,
+                    listing.area,
+                    listing.url,
+                    record[0]
+                ))
+                changed.append((record[0], listing.title, listing.price, listing.city, listing.district, listing.area))
+
+        cursor = conn.cursor()
+        history = []
+        deltas = PriceDeltas()
         try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                
-                # Process updates
-                if updates:
-                    cursor.executemany('''
-                        UPDATE listings 
-                        SET price = ?, city = ?, district = ?, area = ?, url = ?
-                        WHERE listing_id = ?
-                    ''', updates)
-                
-                # Process inserts
-                if inserts:
-                    cursor.executemany('''
-                        INSERT INTO listings (page, title, price, city, district, area, url)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ''', inserts)
-                    
-                    # Update cache with new records
-                    for listing in listings:
-                        if (source, listing.title) not in self.existing_records:
-                            cursor.execute('''
-                                SELECT listing_id FROM listings 
-                                WHERE page = ? AND title = ?
-                            ''', (source, listing.title))
-                            listing_id = cursor.fetchone()[0]
-                            self.existing_records[(source, listing.title)] = listing_id
-                
-                conn.commit()
-        except sqlite3.Error as e:
-            print(f"An error occurred while puting the data into database: {e}")
-            pass
-        finally:
-            print(f"Updated {len(updates)} and inserted {len(inserts)} listings from {source}")
+            seq = next_change(cursor) if updates or inserts else None
+            if updates:
+                # Take the old values out of the price statistics before they are overwritten.
+                ids = [update[-1] for update in updates]
+                for start in range(0, len(ids), UPSERT_CHUNK):
+                    chunk = ids[start:start + UPSERT_CHUNK]
+                    placeholders = ", ".join(["?"] * len(chunk))
+                    for city, district, price, area in cursor.execute(f'''
+                        SELECT city, district, price, area FROM listings WHERE listing_id IN ({placeholders})
+                    ''', chunk):
+                        deltas.add(source, city, district, price, area, -1)
+                cursor.executemany('''
+                    UPDATE listings
+                    SET price = ?, city = ?, district = ?, area = ?, url = ?, updated_at = CURRENT_TIMESTAMP,
+                        change_seq = ?
+                    WHERE listing_id = ?
+                ''', [(*update[:-1], seq, update[-1]) for update in updates])
+                for listing_id, title, price, city, district, area in changed:
+                    if listing_id in repriced:
+                        history.append((listing_id, price, area, seq))
+                    self.cache.put(source, title, (listing_id, price, area, place_key(city, district, latest[title].url)))
+
+            for start in range(0, len(inserts), UPSERT_CHUNK):
+                chunk = inserts[start:start + UPSERT_CHUNK]
+                values = ", ".join(["(?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?)"] * len(chunk))
+                cursor.execute(f'''
+                    INSERT INTO listings (page, title, price, city, district, area, url, updated_at, change_seq)
+                    VALUES {values}
+                    ON CONFLICT (page, title) DO UPDATE SET
+                        price = excluded.price,
+                        city = excluded.city,
+                        district = excluded.district,
+                        area = excluded.area,
+                        url = excluded.url,
+                        updated_at = excluded.updated_at,
+                        change_seq = excluded.change_seq
+                    RETURNING listing_id, title, price, city, district, area
+                ''', [value for row in chunk for value in (*row, seq)])
+
+                # Update cache with the ids of the inserted rows
+                for row in cursor.fetchall():
+                    listing_id, title, price, city, district, area = row
+                    history.append((listing_id, price, area, seq))
+                    changed.append(row)
+                    self.cache.put(source, title, (listing_id, price, area,
+                                                   place_key(city, district, latest[title].url)))
+
+            if history:
+                cursor.executemany('''
+                    INSERT INTO listing_prices (listing_id, price, area, change_seq) VALUES (?, ?, ?, ?)
+                ''', history)
+
+            index_listings(cursor, source, changed)
+            # changed holds the updated listings first, then the inserted ones.
+            cursor.executemany('''
+                INSERT INTO detail_queue (listing_id, priority) VALUES (?, ?)
+                ON CONFLICT (listing_id) DO UPDATE SET
+                    priority = MIN(priority, excluded.priority),
+                    attempts = 0,
+                    queued_at = CURRENT_TIMESTAMP
+            ''', [(row[0], DETAIL_PRIORITY_CHANGED if number < len(updates) else DETAIL_PRIORITY_NEW)
+                  for number, row in enumerate(changed)])
+            for _, _, price, city, district, area in changed:
+                deltas.add(source, city, district, price, area)
+            deltas.apply(cursor)
+        except Exception:
+            self.forget(touched)
+            raise
+
+        return len(updates), len(inserts), touched
+
+    def forget(self, keys):
+        for source, title in keys:
+            self.cache.discard(source, title)